@@ -0,0 +1,155 @@
+"""ベンチマーク用の合成データ生成。
+
+指定した規模の生産者・商品・消費者・カート (と売れ行きの集計値) をDBに投入する。乱数の種を固定しているので、
+同じ引数なら毎回同じデータになり、ベンチマーク結果を実行間で比較できる。
+
+使い方:
+    python benchmarks/datagen.py --database sqlite:////tmp/bench.db \\
+        --producers 10000 --products 1000000 --consumers 100000
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+import server  # noqa: E402
+
+BENCH_PASSWORD = 'password123' # 生成するアカウント共通のパスワード (load.py のログインで使う)
+BATCH_SIZE = 10000
+
+VEGETABLES = ['トマト', 'ほうれん草', '大根', 'キャベツ', 'きゅうり', 'なす', 'にんじん', 'じゃがいも',
+              '玉ねぎ', 'ピーマン', 'レタス', 'ブロッコリー', 'かぼちゃ', 'とうもろこし', 'すいか', 'しいたけ']
+ADJECTIVES = ['新鮮', '朝採れ', '有機栽培', '完熟', '甘い', '大玉', '訳あり', '旬の', '無農薬', '産地直送']
+PHRASES = ['甘くてみずみずしい', 'シャキシャキの食感', '煮物にもサラダにも', '栄養満点',
+           '太陽の恵みをたっぷり浴びた', '採れたてをお届け', '農家こだわりの', 'お子様にも人気の']
+
+
+def sample_images():
+    # 既存のアップロード画像を使い回す (派生画像・srcset の処理も計測に含めるため)
+    folder = os.path.join(server.UPLOAD_FOLDER, 'yasai')
+    if not os.path.isdir(folder):
+        return [server.DEFAULT_PROFILE_IMAGE_PLACEHOLDER]
+    return [f'/static/uploads/yasai/{name}' for name in sorted(os.listdir(folder)) if server.allowed_file(name)]
+
+
+def insert_batches(model, rows):
+    # ORM オブジェクトを作らず、executemany でまとめて INSERT する
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            server.db.session.execute(server.db.insert(model), batch)
+            server.db.session.commit()
+            batch = []
+    if batch:
+        server.db.session.execute(server.db.insert(model), batch)
+        server.db.session.commit()
+
+
+def generate(producers, products, consumers, cart_items, seed):
+    rng = random.Random(seed)
+    password = generate_password_hash(BENCH_PASSWORD, server.PASSWORD_HASH_METHOD)
+    images = sample_images()
+    timings = {}
+
+    # ユーザー名には ID を使い、既存のデータに追記しても重複しないようにする
+    start = time.perf_counter()
+    first_producer = (server.db.session.query(server.db.func.max(server.Producer.id)).scalar() or 0) + 1
+    insert_batches(server.Producer, ({
+        'username': f'bench_producer_{first_producer + i}',
+        'password': password,
+        'account_name': f'{rng.choice(ADJECTIVES)}農園{i}',
+        'bio': rng.choice(PHRASES) + '野菜を育てています。',
+        'profile_image': rng.choice(images),
+        'youtube_video': '',
+    } for i in range(producers)))
+    timings['producers'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_product = (server.db.session.query(server.db.func.max(server.Product.id)).scalar() or 0) + 1
+    insert_batches(server.Product, ({
+        'name': f'{rng.choice(ADJECTIVES)}{rng.choice(VEGETABLES)}',
+        'price': rng.randrange(50, 3000, 10),
+        'description': f'{rng.choice(PHRASES)}{rng.choice(VEGETABLES)}です。{rng.choice(PHRASES)}。',
+        'image_url': rng.choice(images),
+        'producer_id': first_producer + rng.randrange(producers),
+    } for _ in range(products)))
+    timings['products'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_consumer = (server.db.session.query(server.db.func.max(server.Consumer.id)).scalar() or 0) + 1
+    insert_batches(server.Consumer, ({
+        'username': f'bench_consumer_{first_consumer + i}',
+        'password': password,
+    } for i in range(consumers)))
+    timings['consumers'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    today = datetime.date.today()
+    added = defaultdict(int) # (商品ID, 日付) -> カートに入れられた数量
+
+    def cart_rows():
+        for consumer_id in range(first_consumer, first_consumer + consumers):
+            count = min(products, rng.randint(0, cart_items * 2))
+            for product_id in rng.sample(range(first_product, first_product + products), count):
+                quantity = rng.randint(1, 5)
+                added[product_id, today - datetime.timedelta(days=rng.randrange(server.ANALYTICS_DAYS))] += quantity
+                yield {'consumer_id': consumer_id, 'product_id': product_id, 'quantity': quantity}
+    insert_batches(server.CartItem, cart_rows())
+    timings['cart_items'] = time.perf_counter() - start
+
+    # カートの版番号と売れ行きの集計値も、アプリでカートを操作した場合と同じように用意する
+    start = time.perf_counter()
+    session = server.db.session
+    session.execute(server.db.insert(server.CartVersion).from_select(
+        ['consumer_id', 'version'],
+        server.db.select(server.CartItem.consumer_id, server.db.literal(1)).distinct()
+        .where(server.CartItem.consumer_id >= first_consumer)))
+    insert_batches(server.ProductDailyStat, ({
+        'product_id': product_id, 'day': day, 'added_quantity': quantity, 'removed_quantity': 0,
+    } for (product_id, day), quantity in added.items()))
+    session.execute(server.db.insert(server.ProducerDailyStat).from_select(
+        ['producer_id', 'day', 'added_quantity', 'removed_quantity'],
+        server.db.select(server.Product.producer_id, server.ProductDailyStat.day,
+                         server.db.func.sum(server.ProductDailyStat.added_quantity), server.db.literal(0))
+        .join(server.Product, server.Product.id == server.ProductDailyStat.product_id)
+        .where(server.Product.id >= first_product)
+        .group_by(server.Product.producer_id, server.ProductDailyStat.day)))
+    server.rollup_analytics() # 商品別・生産者別の集計値を作り直して commit する
+    timings['analytics'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    server.rebuild_search_index()
+    timings['search_index'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=os.environ.get('DATABASE_URL', 'sqlite:///bench.db'),
+                        help='投入先のDB URL (既存のデータには追記する)')
+    parser.add_argument('--producers', type=int, default=100)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--consumers', type=int, default=1000)
+    parser.add_argument('--cart-items', type=int, default=3, help='消費者1人あたりの平均カート商品数')
+    parser.add_argument('--seed', type=int, default=42, help='乱数の種')
+    args = parser.parse_args()
+
+    app = server.create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    with app.app_context():
+        server.init_db()
+        timings = generate(args.producers, args.products, args.consumers, args.cart_items, args.seed)
+    for name, seconds in timings.items():
+        print(f'{name:<14} {seconds:8.2f} s')
+
+
+if __name__ == '__main__':
+    main()
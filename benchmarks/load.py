@@ -0,0 +1,342 @@
+"""負荷試験・ベンチマーク。
+
+実際のルート (/, /producer/<id>, /cart, /add_to_cart, /api/products, /api/search, ログイン) に
+リクエストを送り、シナリオごとのレイテンシ (p50/p95/p99)・スループットと、プロセスの最大RSSを
+JSON に書き出す。乱数の種を固定しているため、同じデータ・同じ引数なら実行間で比較できる。
+
+  --mode client : Flask のテストクライアントで直列に実行 (ルートとDBの処理時間)
+  --mode http   : ローカルにHTTPサーバーを立て、複数スレッドから同時に実行 (並行時の性能)
+
+使い方:
+    python benchmarks/datagen.py --database sqlite:////tmp/bench.db --products 1000000
+    python benchmarks/load.py --database sqlite:////tmp/bench.db --mode http --concurrency 16 \\
+        --output after.json --compare before.json
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.serving import make_server  # noqa: E402
+
+import server  # noqa: E402
+from datagen import ADJECTIVES, BENCH_PASSWORD, VEGETABLES  # noqa: E402
+
+SEARCH_TERMS = ['トマト', '大根', '新鮮', 'ほうれん草', '完熟すいか', 'にんじん', '農園1', 'シャキシャキ']
+SORTS = list(server.PRODUCT_SORTS)
+
+
+def collect_context(app):
+    """シナリオで使うIDの範囲などをDBから読む。"""
+    with app.app_context():
+        query = server.db.session.query
+        func = server.db.func
+        context = {
+            'product_ids': query(func.min(server.Product.id), func.max(server.Product.id)).one(),
+            'producer_ids': query(func.min(server.Producer.id), func.max(server.Producer.id)).one(),
+            'consumer_ids': [row[0] for row in query(server.Consumer.id)
+                             .filter(server.Consumer.username.like('bench_consumer_%')).limit(1000)],
+            'consumer_names': [row[0] for row in query(server.Consumer.username)
+                               .filter(server.Consumer.username.like('bench_consumer_%')).limit(1000)],
+            'producer_names': [row[0] for row in query(server.Producer.username)
+                               .filter(server.Producer.username.like('bench_producer_%')).limit(1000)],
+        }
+    if context['product_ids'][0] is None:
+        raise SystemExit('商品がありません。先に benchmarks/datagen.py でデータを作成してください。')
+    return context
+
+
+def build_scenarios(context):
+    """シナリオ名 -> (ログインが必要か, リクエストを作る関数)。関数は (method, path, form, json) を返す。"""
+    low_product, high_product = context['product_ids']
+    low_producer, high_producer = context['producer_ids']
+
+    def random_cursor(rng, sort):
+        # 深いページも含めて計測するため、ランダムな位置から読み始める
+        product_id = rng.randint(low_product, high_product)
+        column, _ = server.PRODUCT_SORTS[sort]
+        if column == 'price':
+            return server.encode_cursor([rng.randrange(50, 3000, 10), product_id])
+        if column == 'name':
+            return server.encode_cursor([rng.choice(ADJECTIVES) + rng.choice(VEGETABLES), product_id])
+        return server.encode_cursor([product_id])
+
+    def index(rng):
+        return 'GET', '/?' + urllib.parse.urlencode({'sort': rng.choice(SORTS)}), None, None
+
+    def index_deep(rng):
+        sort = rng.choice(SORTS)
+        return 'GET', '/?' + urllib.parse.urlencode({'sort': sort, 'cursor': random_cursor(rng, sort)}), None, None
+
+    def api_products(rng):
+        sort = rng.choice(SORTS)
+        params = {'sort': sort, 'cursor': random_cursor(rng, sort)}
+        return 'GET', '/api/products?' + urllib.parse.urlencode(params), None, None
+
+    def api_search(rng):
+        return 'GET', '/api/search?' + urllib.parse.urlencode({'q': rng.choice(SEARCH_TERMS)}), None, None
+
+    def producer_profile(rng):
+        return 'GET', f'/producer/{rng.randint(low_producer, high_producer)}', None, None
+
+    def cart(rng):
+        return 'GET', '/cart', None, None
+
+    def add_to_cart(rng):
+        return 'POST', '/add_to_cart', None, {'product_id': rng.randint(low_product, high_product), 'quantity': 1}
+
+    def cart_summary(rng):
+        return 'GET', '/api/cart/summary', None, None
+
+    def consumer_login(rng):
+        return 'POST', '/consumer/login', {'username': rng.choice(context['consumer_names']),
+                                           'password': BENCH_PASSWORD}, None
+
+    def producer_login(rng):
+        return 'POST', '/producer/login', {'username': rng.choice(context['producer_names']),
+                                           'password': BENCH_PASSWORD}, None
+
+    # *_nocache は毎回断片キャッシュを空にしてから送り、キャッシュに当たらない時の描画を計測する
+    scenarios = {
+        'index': (False, index),
+        'index_deep': (False, index_deep),
+        'index_nocache': (False, index),
+        'api_products': (False, api_products),
+        'api_search': (False, api_search),
+        'producer_profile': (False, producer_profile),
+        'producer_profile_nocache': (False, producer_profile),
+    }
+    if context['consumer_ids']:
+        scenarios.update({
+            'cart': (True, cart),
+            'add_to_cart': (True, add_to_cart),
+            'cart_summary': (True, cart_summary),
+            'consumer_login': (False, consumer_login),
+        })
+    if context['producer_names']:
+        scenarios['producer_login'] = (False, producer_login)
+    return scenarios
+
+
+def percentile(sorted_values, fraction):
+    # 最近接順位法
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': (sum(latencies) / count * 1000) if count else 0.0,
+        'throughput_rps': count / elapsed if elapsed else 0.0,
+    }
+
+
+def run_client(app, context, scenarios, requests, login_requests, seed):
+    """テストクライアントで各シナリオを直列に実行する。"""
+    results = {}
+    for name, (needs_login, make_request) in scenarios.items():
+        rng = random.Random(f'{seed}-{name}')
+        client = app.test_client()
+        if needs_login:
+            with client.session_transaction() as session:
+                session['consumer_id'] = rng.choice(context['consumer_ids'])
+        count = login_requests if name.endswith('_login') else requests
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(count):
+            method, path, form, body = make_request(rng)
+            if name.endswith('_nocache'):
+                server.fragment_cache.clear()
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=form, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+        results[name] = summarize(latencies, errors, time.perf_counter() - started)
+    return results
+
+
+def run_http(app, context, scenarios, requests, login_requests, seed, concurrency):
+    """ローカルのHTTPサーバーに対して、各シナリオを concurrency 本のスレッドで同時に実行する。"""
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # リクエストごとのアクセスログを出さない
+    httpd = make_server('127.0.0.1', 0, app, threaded=True)
+    base_url = f'http://127.0.0.1:{httpd.server_port}'
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def make_opener(consumer_name=None):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                             NoRedirect())
+        if consumer_name:
+            # 計測前にログインしてセッションCookieを得る
+            data = urllib.parse.urlencode({'username': consumer_name, 'password': BENCH_PASSWORD}).encode()
+            send(opener, 'POST', '/consumer/login', data, None)
+        return opener
+
+    def send(opener, method, path, form, body):
+        headers = {}
+        data = form
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(base_url + path, data=data, method=method, headers=headers)
+        try:
+            with opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+    results = {}
+    try:
+        for name, (needs_login, make_request) in scenarios.items():
+            rng = random.Random(f'{seed}-{name}')
+            count = login_requests if name.endswith('_login') else requests
+            planned = [make_request(rng) for _ in range(count)]
+            users = [rng.choice(context['consumer_names']) if needs_login else None for _ in range(concurrency)]
+            openers = list(ThreadPoolExecutor(max_workers=concurrency).map(make_opener, users))
+            latencies, errors = [], 0
+            lock = threading.Lock()
+
+            def worker(index):
+                nonlocal errors
+                opener = openers[index]
+                for method, path, form, body in planned[index::concurrency]:
+                    if form is not None:
+                        form = urllib.parse.urlencode(form).encode()
+                    if name.endswith('_nocache'):
+                        server.fragment_cache.clear() # サーバーは同じプロセスで動いている
+                    start = time.perf_counter()
+                    status = send(opener, method, path, form, body)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        if status >= 400:
+                            errors += 1
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(worker, range(concurrency)))
+            results[name] = summarize(latencies, errors, time.perf_counter() - started)
+    finally:
+        httpd.shutdown()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, previous_path, max_regression):
+    """前回の結果と p95 を比べて表示する。max_regression を超えて遅くなったシナリオがあれば False。"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    ok = True
+    for key in ('mode', 'concurrency', 'products'):
+        if previous.get('meta', {}).get(key) != current['meta'][key]:
+            print(f'注意: {key} が前回と異なります ({previous.get("meta", {}).get(key)} -> {current["meta"][key]})')
+    print(f'\n{"scenario":<24} {"p95 before":>11} {"p95 after":>11} {"change":>8}')
+    for name, stats in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before or not before['p95_ms']:
+            continue
+        change = stats['p95_ms'] / before['p95_ms'] - 1
+        flag = ''
+        if change > max_regression:
+            flag = '  REGRESSION'
+            ok = False
+        print(f'{name:<24} {before["p95_ms"]:>9.2f}ms {stats["p95_ms"]:>9.2f}ms {change:>+7.1%}{flag}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=os.environ.get('DATABASE_URL', 'sqlite:///bench.db'))
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--requests', type=int, default=500, help='シナリオあたりのリクエスト数')
+    parser.add_argument('--login-requests', type=int, default=20,
+                        help='ログインのシナリオのリクエスト数 (パスワードハッシュが重いため少なめ)')
+    parser.add_argument('--concurrency', type=int, default=8, help='http モードの同時接続数')
+    parser.add_argument('--scenario', action='append', help='実行するシナリオ (複数指定可。省略時はすべて)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json', help='結果を書き出す JSON ファイル')
+    parser.add_argument('--compare', help='比較する前回の結果 JSON')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='--compare で許容する p95 の悪化率 (超えたら終了コード1)')
+    args = parser.parse_args()
+
+    app = server.create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    context = collect_context(app)
+    scenarios = build_scenarios(context)
+    if args.scenario:
+        scenarios = {name: scenarios[name] for name in args.scenario}
+
+    started = time.time()
+    if args.mode == 'client':
+        results = run_client(app, context, scenarios, args.requests, args.login_requests, args.seed)
+    else:
+        results = run_http(app, context, scenarios, args.requests, args.login_requests, args.seed,
+                           args.concurrency)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': args.mode,
+            'concurrency': args.concurrency if args.mode == 'http' else 1,
+            'requests': args.requests,
+            'seed': args.seed,
+            'products': context['product_ids'][1] - context['product_ids'][0] + 1,
+        },
+        'scenarios': results,
+        # Linux では KB 単位、macOS では byte 単位
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f'{"scenario":<24} {"req":>6} {"err":>5} {"p50":>9} {"p95":>9} {"p99":>9} {"rps":>9}')
+    for name, stats in results.items():
+        print(f'{name:<24} {stats["requests"]:>6} {stats["errors"]:>5} {stats["p50_ms"]:>7.2f}ms '
+              f'{stats["p95_ms"]:>7.2f}ms {stats["p99_ms"]:>7.2f}ms {stats["throughput_rps"]:>9.1f}')
+    print(f'peak RSS: {report["peak_rss_mb"]:.1f} MB  -> {args.output}')
+
+    if args.compare and not compare(report, args.compare, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""起動時間の計測。
+
+新しいプロセスで server を import し、アプリを作って最初のリクエスト (/) を返すまでの時間を測る。
+各ワーカープロセスの起動で毎回かかる時間の目安になる。
+
+使い方:
+    python benchmarks/startup.py                # このリポジトリを計測
+    python benchmarks/startup.py --path ../old  # 別のチェックアウト (変更前など) を計測
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# 子プロセスで実行する計測コード。create_app が無い古い server.py (import 時に app を作る) にも対応する
+PROBE = r'''
+import json, time
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+app = server.create_app() if hasattr(server, 'create_app') else server.app
+created = time.perf_counter()
+response = app.test_client().get('/')
+finished = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (finished - created) * 1000,
+    'total_ms': (finished - start) * 1000,
+    'status': response.status_code,
+}))
+'''
+
+
+def measure(path):
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=path, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=os.path.join(os.path.dirname(__file__), '..'),
+                        help='server.py があるディレクトリ')
+    parser.add_argument('--repeat', type=int, default=5, help='計測回数 (中央値を出す)')
+    parser.add_argument('--output', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args()
+
+    runs = [measure(args.path) for _ in range(args.repeat)]
+    summary = {key: statistics.median(run[key] for run in runs)
+               for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms')}
+    summary['status'] = runs[-1]['status']
+    summary['repeat'] = args.repeat
+
+    for key, value in summary.items():
+        print(f'{key:<18} {value:10.1f}' if isinstance(value, float) else f'{key:<18} {value:>10}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'summary': summary, 'runs': runs}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
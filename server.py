@@ -1,29 +1,190 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, g, current_app, has_request_context, abort
+from flask import Request, before_render_template, template_rendered, send_file, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import delete, event, func, insert, inspect, literal, select, text
+from sqlalchemy.engine import Engine, make_url
+from markupsafe import Markup
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
+from functools import wraps
+import base64
+import bisect
+import click
+import csv
+import datetime
+import gzip
+import hashlib
+import io
 import json
+import logging
+import mimetypes
 import os
+import queue
+import re
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
 import uuid
-
-app = Flask(__name__)
+import zipfile
+
+try:
+    from PIL import Image, ImageOps # 画像の縮小版 (サムネイル/WebP) の生成に使用
+except ImportError:
+    Image = None
+
+try:
+    import brotli # 静的ファイルの事前圧縮 (.br) に使用。無ければ gzip のみ
+except ImportError:
+    brotli = None
+
+try:
+    import redis # 複数プロセス間での変更通知の中継 (EVENT_BROKER_URL) に使用
+except ImportError:
+    redis = None
+
+try:
+    import fcntl # カタログのスナップショットを作るプロセスを1つに決めるファイルロックに使用 (Unix のみ)
+except ImportError:
+    fcntl = None
+
+# ルート・CLIコマンドはこの Blueprint に登録し、create_app() でアプリに組み込む。
+# import 時にはDBやファイルに触れない (DB作成・初期データ投入は CLI コマンドで明示的に行う)
+bp = Blueprint('main', __name__, cli_group=None)
+logger = logging.getLogger(__name__)
+
+def running_under_gevent():
+    """gevent のワーカー (monkey.patch_all() 済み) の中で動いているか。"""
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('threading')
+
+class CpuPool:
+    """CPU を使う処理 (パスワードハッシュ・画像の縮小・スナップショットの作成) 用のスレッドプール。
+    gevent のワーカーでは threading がグリーンレットに置き換わり、普通のスレッドプールの処理はイベントループを止めて
+    同じワーカーの全リクエスト・SSE 接続を待たせてしまう。そのため gevent の下では、本物のスレッドで動かす
+    gevent.threadpool.ThreadPoolExecutor を使う。--preload などで monkey パッチより先に import されても
+    判定できるよう、プールは最初に使う時に作る。"""
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            if self._executor is None:
+                if running_under_gevent():
+                    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+                    self._executor = NativeThreadPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._executor.submit(func, *args, **kwargs)
 
 # セキュリティのためのセッションキー設定
-app.secret_key = 'your_secret_key_very_secret_and_random' # より複雑なキーに変更推奨
+SECRET_KEY = os.environ.get('SECRET_KEY', 'your_secret_key_very_secret_and_random') # より複雑なキーに変更推奨
 
 # ファイルアップロード設定
 UPLOAD_FOLDER = 'static/uploads' # 画像を保存するフォルダ
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'} # 許可するファイル拡張子
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# UPLOAD_FOLDERが存在しない場合は作成
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-# データベース設定
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///platform.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+MAX_UPLOAD_MB = float(os.environ.get('MAX_UPLOAD_MB', '16')) # リクエスト本体の上限 (MB)。超えたら読み込まずに 413
+MAX_IMPORT_MB = float(os.environ.get('MAX_IMPORT_MB', '256')) # 商品の一括登録 (画像zip込み) の上限 (MB)
+STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cas') # 内容のハッシュ名で保存するフォルダ
+# 受信中のファイル。static の外に置き、どのルートからも配信されないようにする (保存先と同じファイルシステムに置く)
+UPLOAD_TMP_FOLDER = os.path.join('instance', 'upload_tmp')
+
+# アップロード画像の縮小版 (派生画像) の設定
+DERIVED_FOLDER = os.path.join(UPLOAD_FOLDER, 'derived') # 派生画像の保存先
+DERIVATIVE_WIDTHS = (96, 192, 384, 768) # 生成する横幅 (px)
+DERIVATIVE_FORMATS = {'jpeg': 'jpg', 'webp': 'webp'} # 形式 -> 拡張子
+DERIVATIVE_QUALITY = 80
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2')) # 画像処理スレッド数
+image_executor = CpuPool(IMAGE_WORKERS, 'image')
+
+# データベース設定 (環境変数で切り替え)
+# DATABASE_URL: 書き込み用 (既定は SQLite)。DATABASE_READ_URL: 読み取り専用ルートで使うレプリカ (任意)
+def normalize_database_url(url):
+    # Heroku 形式の postgres:// は SQLAlchemy では postgresql:// と書く必要がある
+    return 'postgresql://' + url[len('postgres://'):] if url.startswith('postgres://') else url
+
+DATABASE_URL = normalize_database_url(os.environ.get('DATABASE_URL', 'sqlite:///platform.db'))
+DATABASE_READ_URL = normalize_database_url(os.environ.get('DATABASE_READ_URL', ''))
+
+# SQLite の接続ごとの設定
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000')) # ロック待ちの上限
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))) # メモリマップするサイズ (byte)
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', str(64 * 1024))) # ページキャッシュ (KB)
+
+# PostgreSQL などサーバー型DBのコネクションプール設定
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30')) # 秒
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800')) # 秒。DB側で切られる前に張り直す
+
+def engine_options(url):
+    """接続先の種類に合わせたエンジン設定を返す。"""
+    if make_url(url).get_backend_name() == 'sqlite':
+        # プールは SQLAlchemy の既定 (ファイルDBは QueuePool) のまま。PRAGMA は接続時に設定する
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': True, # 切れた接続をリクエスト中に掴まないよう、貸し出し前に確認する
+    }
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL にすると書き込み中も読み取りがブロックされない。synchronous=NORMAL は WAL では安全で高速
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}') # 負の値は KB 単位
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+class RoutingSession(FlaskSession):
+    """読み取り専用としてマークされたリクエストでは、レプリカのエンジンを使うセッション。"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() \
+                and g.get('use_read_replica') and 'replica' in db.engines:
+            return db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def read_only(view):
+    """読み取りしか行わないルートに付ける。DATABASE_READ_URL があればレプリカから読む。"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def render_from_primary(render):
+    """render() の中の読み取りをレプリカではなく primary で行う (書き込み直後でレプリカが遅れている場合用)。"""
+    if not has_request_context():
+        return render()
+    previous = g.get('use_read_replica', False)
+    g.use_read_replica = False
+    try:
+        return render()
+    finally:
+        g.use_read_replica = previous
 
 # Consumer, Producer, Product, CartItem モデルの定義
 class Consumer(db.Model):
@@ -43,6 +204,13 @@ class Producer(db.Model):
     products = db.relationship('Product', backref='producer', lazy=True, cascade="all, delete-orphan")
 
 class Product(db.Model):
+    # 生産者ごとの商品の取得と、一覧の並べ替え (キーセット方式のページング) に使うインデックス
+    __table_args__ = (
+        db.Index('ix_product_producer_id', 'producer_id'),
+        db.Index('ix_product_price_id', 'price', 'id'),
+        db.Index('ix_product_name_id', 'name', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     price = db.Column(db.Integer, nullable=False)
@@ -52,61 +220,1694 @@ class Product(db.Model):
     cart_items = db.relationship('CartItem', backref='product', lazy=True, cascade="all, delete-orphan")
 
 class CartItem(db.Model):
+    # 同じ消費者・商品の行は1行にまとめ、数量で表す (upsert の衝突判定にも使う)
+    # consumer_id だけの検索 (カートの表示) もこの一意インデックスで足りる
+    __table_args__ = (
+        db.Index('uq_cart_item_consumer_product', 'consumer_id', 'product_id', unique=True),
+        db.Index('ix_cart_item_product_id', 'product_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     consumer_id = db.Column(db.Integer, db.ForeignKey('consumer.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, default=1, nullable=False)
 
+class StoredUpload(db.Model):
+    # 内容のハッシュ名で保存したアップロードファイルと、それを参照している商品・生産者の数
+    path = db.Column(db.String(200), primary_key=True) # UPLOAD_FOLDER からの相対パス
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+
+class SchemaMigration(db.Model):
+    # 適用済みのマイグレーション (MIGRATIONS の番号)
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+class FragmentVersion(db.Model):
+    # 断片キャッシュのバージョン番号 (FragmentCache)。全プロセスで共有する。
+    # version は全スコープ共通の通し番号で、scope = '' の行が最後に払い出した番号を持つ
+    __table_args__ = (db.Index('ix_fragment_version_version', 'version'),)
+    scope = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+class CartVersion(db.Model):
+    # 消費者ごとのカートの版番号。カートを変更するたびに同じトランザクションで1つ進め、ETag に使う
+    consumer_id = db.Column(db.Integer, db.ForeignKey('consumer.id'), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+# 売れ行きの集計値。カート操作と同じトランザクションで差分を加算し、ダッシュボードは集計せずに読む
+class ProductStat(db.Model):
+    # 生産者ごとに数量の多い順で読むためのインデックス
+    __table_args__ = (
+        db.Index('ix_product_stat_producer_quantity', 'producer_id', 'quantity', 'product_id'),
+    )
+
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    producer_id = db.Column(db.Integer, db.ForeignKey('producer.id'), nullable=False)
+    cart_count = db.Column(db.Integer, default=0, nullable=False) # この商品が入っているカートの数
+    quantity = db.Column(db.Integer, default=0, nullable=False) # カート内の合計数量
+
+class ProducerStat(db.Model):
+    producer_id = db.Column(db.Integer, db.ForeignKey('producer.id'), primary_key=True)
+    cart_count = db.Column(db.Integer, default=0, nullable=False) # 商品ごとの cart_count の合計
+    quantity = db.Column(db.Integer, default=0, nullable=False)
+
+class ProductDailyStat(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    added_quantity = db.Column(db.Integer, default=0, nullable=False) # その日にカートに入れられた数量
+    removed_quantity = db.Column(db.Integer, default=0, nullable=False) # その日にカートから外された数量
+
+class ProducerDailyStat(db.Model):
+    producer_id = db.Column(db.Integer, db.ForeignKey('producer.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    added_quantity = db.Column(db.Integer, default=0, nullable=False)
+    removed_quantity = db.Column(db.Integer, default=0, nullable=False)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-with app.app_context():
-    db.create_all()
+# パスワードハッシュ
+# ハッシュ計算 (KDF) はCPUを大きく使うため、同時実行数を絞った専用スレッドプールで行う。
+# 実行中+待ち行列が上限に達したら待たずに 503 を返し、通常のページ表示を巻き込まないようにする。
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1') # werkzeug の method 形式
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', '16')) # 実行待ちにできる件数
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', '10')) # 秒
+password_executor = CpuPool(PASSWORD_HASH_WORKERS, 'password')
+_password_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+_password_hash_prefix = {}
+
+class PasswordHasherBusy(Exception):
+    """パスワードハッシュの処理が混雑していて受け付けられない。"""
+
+def _run_password_task(func, *args):
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordHasherBusy()
+    try:
+        future = password_executor.submit(func, *args)
+    except Exception:
+        _password_slots.release()
+        raise
+    future.add_done_callback(lambda _: _password_slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        raise PasswordHasherBusy()
+
+def hash_password(password, method=None):
+    return _run_password_task(generate_password_hash, password, method or PASSWORD_HASH_METHOD)
+
+def verify_password(stored_hash, password):
+    return _run_password_task(check_password_hash, stored_hash, password)
+
+def password_needs_rehash(stored_hash, method=None):
+    # 保存済みハッシュの先頭 ("scrypt:32768:8:1" など) が現在の設定と違えば作り直す
+    method = method or PASSWORD_HASH_METHOD
+    if method not in _password_hash_prefix:
+        # 'scrypt' のような省略形は既定値を補った形で保存されるため、実際に1回作って比較用の形を得る
+        _password_hash_prefix[method] = generate_password_hash('', method).split('$', 1)[0]
+    return stored_hash.split('$', 1)[0] != _password_hash_prefix[method]
+
+def upgrade_password_hash(account, password):
+    """ログイン成功時に、古い設定のハッシュを現在の設定で作り直す。混雑時は次回に回す。"""
+    if not password_needs_rehash(account.password):
+        return
+    try:
+        account.password = hash_password(password)
+    except PasswordHasherBusy:
+        return
+    db.session.commit()
 
-# 初期データを追加（もしデータが空の場合）
-with app.app_context():
-    producer1 = Producer.query.filter_by(username='tachi_farm').first()
-    if not producer1:
-        # 新しい初期プロフィール画像を static/uploads に保存する例
-        default_profile_image_filename = 'default_producer_profile.jpg'
-        default_profile_image_path = os.path.join(app.config['UPLOAD_FOLDER'], default_profile_image_filename)
-        # ダミー画像ファイルを生成 (もし存在しなければ)
-        if not os.path.exists(default_profile_image_path):
-            from PIL import Image, ImageDraw, ImageFont # Pillow ライブラリが必要
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    response = current_app.response_class('只今ログインが混み合っています。しばらくしてから再度お試しください。',
+                                  status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = '1'
+    return response
+
+@bp.cli.command('bench-password-hash')
+@click.option('--method', 'methods', multiple=True,
+              help='計測する method (複数指定可)。省略時は代表的な設定を計測する')
+@click.option('--seconds', default=3.0, help='各設定の計測時間 (秒)')
+@click.option('--threads', default=PASSWORD_HASH_WORKERS, help='同時にログインさせるスレッド数')
+def bench_password_hash_command(methods, seconds, threads):
+    """パスワード検証 (=ログイン1回分) の処理速度を設定ごとに計測する。"""
+    methods = methods or (PASSWORD_HASH_METHOD, 'scrypt:16384:8:1', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:260000')
+    for method in dict.fromkeys(methods):
+        stored_hash = generate_password_hash('password123', method)
+
+        def worker(deadline):
+            count = 0
+            while time.perf_counter() < deadline:
+                check_password_hash(stored_hash, 'password123')
+                count += 1
+            return count
+
+        start = time.perf_counter()
+        single = worker(start + seconds / 2)
+        single_rate = single / (time.perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            start = time.perf_counter()
+            futures = [executor.submit(worker, start + seconds / 2) for _ in range(threads)]
+            total = sum(future.result() for future in futures)
+            parallel_rate = total / (time.perf_counter() - start)
+        print(f'{method:<24} 1スレッド: {single_rate:8.1f} logins/sec  {threads}スレッド: {parallel_rate:8.1f} logins/sec')
+
+# 描画済みHTML断片のキャッシュ
+class FragmentCache:
+    """描画済みのHTML断片を保持する LRU キャッシュ。
+    キーには対象のバージョン番号を含め、書き込み側が bump() で番号を進めることで古い断片を参照されなくする。
+    古いキーの断片は LRU で自然に追い出される。バージョン番号は FragmentVersion テーブルで全プロセスと共有し
+    (別のワーカーや import-products などのコマンドからの変更も反映する)、各プロセスは sync_interval 秒ごとに
+    前回より新しい番号だけを読み直す。"""
+
+    def __init__(self, max_entries, sync_interval, replica_lag):
+        self.max_entries = max_entries
+        self.sync_interval = sync_interval
+        self.replica_lag = replica_lag
+        self.app = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._changed_at = {} # スコープ -> このプロセスで新しい番号を知った時刻
+        self._seen = 0 # 読み込み済みの最大の番号
+        self._synced_at = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # アプリ (DB) が替わったら、前のDBの番号と断片は使わない
+        with self._lock:
+            self.app = app
+            self._entries.clear()
+            self._versions.clear()
+            self._changed_at.clear()
+            self._seen = 0
+            self._synced_at = None
+
+    @staticmethod
+    def _scope_key(scope):
+        return scope if isinstance(scope, str) else ':'.join(map(str, scope))
+
+    def _app_context(self):
+        # 画像処理のスレッドなど、アプリのコンテキストの外から呼ばれる場合がある
+        return nullcontext() if has_app_context() else self.app.app_context()
+
+    def _sync(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.app is None or (self._synced_at is not None and now - self._synced_at < self.sync_interval):
+                return
+            first = self._synced_at is None
+            self._synced_at = now
+            seen = self._seen
+        # セッションとは別の接続で primary から読む (レプリカの遅れの影響を受けない)
+        with self._app_context(), db.engine.connect() as connection:
+            rows = connection.execute(select(FragmentVersion.scope, FragmentVersion.version)
+                                      .where(FragmentVersion.version > seen)).all()
+        self._apply(rows, None if first else now) # 起動時に読んだ番号は「変更直後」として扱わない
+
+    def _apply(self, rows, changed_at):
+        with self._lock:
+            for scope, version in rows:
+                self._seen = max(self._seen, version)
+                if version > self._versions.get(scope, 0):
+                    self._versions[scope] = version
+                    if changed_at is not None:
+                        self._changed_at[scope] = changed_at
+
+    def version(self, scope):
+        self._sync()
+        return self._versions.get(self._scope_key(scope), 0)
+
+    def bump(self, *scopes):
+        keys = [self._scope_key(scope) for scope in scopes]
+        if self.app is None:
+            with self._lock:
+                self._seen += 1
+            self._apply([(key, self._seen) for key in keys], time.monotonic())
+            return
+        # 通し番号の行を1文で進め、その番号を各スコープに書く。通し番号の行のロックは commit まで保持されるため、
+        # 番号は commit の順に並び、他のプロセスは「前回読んだ番号より大きい行」だけを読めばよい
+        with self._app_context(), db.engine.begin() as connection:
+            stmt = dialect_insert(FragmentVersion).values(scope='', version=1)
+            stmt = stmt.on_conflict_do_update(index_elements=['scope'], set_={'version': FragmentVersion.version + 1})
+            version = connection.execute(stmt.returning(FragmentVersion.version)).scalar()
+            stmt = dialect_insert(FragmentVersion).values([{'scope': key, 'version': version} for key in keys])
+            connection.execute(stmt.on_conflict_do_update(index_elements=['scope'],
+                                                          set_={'version': stmt.excluded.version}))
+        self._apply([(key, version) for key in keys], time.monotonic())
+
+    def get_or_render(self, key, render, scope=None):
+        """キャッシュに無ければ render() の結果を保存して返す (None は保存しない)。
+        scope のバージョンが replica_lag 秒以内に変わった場合は、レプリカが追いついていない恐れがあるため
+        primary から読んで描画する (古い内容を新しいバージョンのキーで保存しないように)。"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            changed_at = self._changed_at.get(self._scope_key(scope)) if scope is not None else None
+        if changed_at is not None and time.monotonic() - changed_at < self.replica_lag:
+            value = render_from_primary(render)
+        else:
+            value = render()
+        if value is None:
+            return None
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', '5000')) # 保持する断片の最大数
+FRAGMENT_CACHE_SYNC_SECONDS = float(os.environ.get('FRAGMENT_CACHE_SYNC_SECONDS', '1')) # 他プロセスの変更を反映するまでの最大の遅れ
+REPLICA_LAG_SECONDS = float(os.environ.get('REPLICA_LAG_SECONDS', '5')) # 変更後、この秒数は primary から描画する
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_SYNC_SECONDS, REPLICA_LAG_SECONDS)
+
+def invalidate_producer(producer_id):
+    # 生産者のプロフィール・商品カードと、それを含む一覧ページのキャッシュを無効にし、
+    # カタログのスナップショットの作り直しを予約する
+    fragment_cache.bump('catalog', ('producer', producer_id))
+    catalog_snapshot.schedule()
+
+# リクエストごとの計測 (メトリクス)
+# リクエスト処理時間・SQLの実行数と合計時間・テンプレート描画時間をエンドポイントごとに集計し、
+# /metrics で Prometheus のテキスト形式で返す。集計はプロセス内で行う。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # 秒
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100) # 1リクエストあたりのSQL実行数
+MAX_RECORDED_STATEMENTS = 50 # 遅いリクエストのログに残すSQLの最大数
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # 最後は +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class RequestMetrics:
+    """エンドポイントごとの計測値を保持する。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.requests = defaultdict(int) # (endpoint, method, status) -> 件数
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+
+    def record(self, endpoint, method, status, seconds, statement_count, sql_seconds, template_seconds):
+        with self._lock:
+            self.latency[endpoint].observe(seconds)
+            self.statements[endpoint].observe(statement_count)
+            self.requests[(endpoint, method, status)] += 1
+            self.sql_seconds[endpoint] += sql_seconds
+            self.template_seconds[endpoint] += template_seconds
+
+    def render(self):
+        """Prometheus のテキスト形式 (version 0.0.4) にする。"""
+        lines = []
+
+        def histogram(name, help_text, histograms):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for endpoint, hist in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {hist.total}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {hist.count}')
+
+        def counter(name, help_text, values):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for endpoint, value in sorted(values.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {value}')
+
+        with self._lock:
+            histogram('http_request_duration_seconds', 'リクエストの処理時間', self.latency)
+            lines.append('# HELP http_requests_total 処理したリクエスト数')
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            histogram('db_statements_per_request', '1リクエストで実行したSQLの数', self.statements)
+            counter('db_statement_seconds_total', 'SQLの実行時間の合計', self.sql_seconds)
+            counter('template_render_seconds_total', 'テンプレートの描画時間の合計', self.template_seconds)
+
+        cache = fragment_cache.stats()
+        lines.append('# TYPE fragment_cache_hits_total counter')
+        lines.append(f'fragment_cache_hits_total {cache["hits"]}')
+        lines.append('# TYPE fragment_cache_misses_total counter')
+        lines.append(f'fragment_cache_misses_total {cache["misses"]}')
+        lines.append('# TYPE fragment_cache_entries gauge')
+        lines.append(f'fragment_cache_entries {cache["entries"]}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if not has_request_context() or 'request_started' not in g:
+        return
+    g.sql_count += 1
+    g.sql_seconds += elapsed
+    if len(g.sql_statements) < MAX_RECORDED_STATEMENTS:
+        g.sql_statements.append((elapsed, statement))
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and 'request_started' in g:
+        g.render_stack.append(time.perf_counter())
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and 'request_started' in g and g.render_stack:
+        started = g.render_stack.pop()
+        if not g.render_stack: # 断片の描画が入れ子になるため、外側の描画時間だけ数える
+            g.template_seconds += time.perf_counter() - started
+
+before_render_template.connect(_before_render)
+template_rendered.connect(_after_render)
+
+class QueryBudgetExceeded(AssertionError):
+    """テスト時に、ルートのSQL実行数が設定した上限を超えた。"""
+
+@bp.before_app_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_count = 0
+    g.sql_seconds = 0.0
+    g.sql_statements = []
+    g.template_seconds = 0.0
+    g.render_stack = []
+
+@bp.after_app_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+    request_metrics.record(endpoint, request.method, response.status_code, elapsed,
+                           g.sql_count, g.sql_seconds, g.template_seconds)
+
+    # 遅いリクエストは、実行したSQLと一緒にログに残す
+    slow_ms = current_app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        statements = '\n'.join(f'  {seconds * 1000:8.2f}ms  {statement}' for seconds, statement in g.sql_statements)
+        logger.warning('遅いリクエスト: %s %s (%s) %.1fms, SQL %d件 %.1fms, 描画 %.1fms\n%s',
+                       request.method, request.path, endpoint, elapsed * 1000, g.sql_count,
+                       g.sql_seconds * 1000, g.template_seconds * 1000, statements)
+
+    # テスト時は SQL 実行数の上限 (N+1 の検出用) を超えたら失敗させる
+    if current_app.testing:
+        budget = current_app.config['SQL_QUERY_BUDGETS'].get(endpoint, current_app.config['SQL_QUERY_BUDGET'])
+        if budget is not None and g.sql_count > budget:
+            statements = '\n'.join(statement for _, statement in g.sql_statements)
+            raise QueryBudgetExceeded(
+                f'{endpoint}: SQLを{g.sql_count}回実行しました (上限 {budget})\n{statements}')
+    return response
+
+@bp.route('/metrics')
+def metrics():
+    # METRICS_TOKEN を設定した場合は Authorization: Bearer <token> を要求する
+    token = current_app.config['METRICS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return current_app.response_class(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# 静的ファイル・メディアの配信
+# /assets/<内容のハッシュ>/<ファイル名> で配信し、内容が変わればURLも変わるため、
+# ブラウザには1年間キャッシュさせてよい (Cache-Control: immutable)。
+# テキスト系は compress-assets で作った .br/.gz をそのまま返し、動画などは Range (206) に応える。
+ASSET_MAX_AGE = 365 * 24 * 60 * 60 # 秒
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.json', '.svg', '.html', '.txt'}
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # 優先順
+ASSET_HASH_LENGTH = 12
+RANGE_CHUNK_SIZE = 64 * 1024
+_asset_hashes = {} # 絶対パス -> ((mtime, size), ハッシュ)
+
+def asset_digest(path):
+    """ファイル内容の SHA-256 (先頭 ASSET_HASH_LENGTH 文字)。更新日時とサイズが同じ間は計算し直さない。"""
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _asset_hashes.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()[:ASSET_HASH_LENGTH]
+    _asset_hashes[path] = (key, value)
+    return value
+
+@bp.app_template_global()
+def asset_url(filename):
+    """static フォルダ内のファイルの、内容のハッシュ入りURL。ファイルが無ければ通常の static のURL。"""
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return url_for('static', filename=filename)
+    return url_for('main.asset', digest=asset_digest(path), filename=filename)
+
+@bp.app_template_filter('media_url')
+def media_url(url):
+    # DBに保存している '/static/...' のURLをハッシュ入りURLにする。外部URLなどはそのまま
+    prefix = f'{current_app.static_url_path}/'
+    if not url or not url.startswith(prefix):
+        return url
+    return asset_url(url[len(prefix):])
+
+def _send_range(path, mimetype, start, length):
+    # 指定範囲だけを返す。サーバーが wsgi.file_wrapper を提供していれば (gunicorn など)
+    # 開始位置に seek したファイルを渡し、Content-Length 分を sendfile で送らせる
+    f = open(path, 'rb')
+    f.seek(start)
+    if 'wsgi.file_wrapper' in request.environ:
+        body = wrap_file(request.environ, f, RANGE_CHUNK_SIZE)
+    else:
+        def body_iter():
+            remaining = length
             try:
-                img = Image.new('RGB', (400, 400), color = (76, 175, 80)) # Green-500
-                d = ImageDraw.Draw(img)
-                # フォントのパスは環境によって異なる可能性があります
+                while remaining > 0:
+                    chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                f.close()
+        body = body_iter()
+    response = current_app.response_class(body, status=206, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    return response
+
+def serve_static_file(filename, immutable):
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    # 事前圧縮したファイルがあり、ブラウザが対応していればそちらを返す
+    encoding = None
+    if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+        for name, suffix in PRECOMPRESSED_ENCODINGS:
+            if name in request.accept_encodings and os.path.isfile(path + suffix) \
+                    and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                encoding, path = name, path + suffix
+                break
+
+    accel_prefix = current_app.config['MEDIA_ACCEL_REDIRECT_PREFIX']
+    byte_range = request.range
+    if accel_prefix:
+        # フロントのプロキシ (nginx) に配信を任せる。Range や sendfile はプロキシ側で処理される
+        relpath = os.path.relpath(path, current_app.static_folder).replace(os.sep, '/')
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + relpath
+    elif byte_range and encoding is None and len(byte_range.ranges) == 1 \
+            and not (request.if_range and request.if_range.etag
+                     and request.if_range.etag != f'{filename}-{asset_digest(path)}'):
+        size = os.path.getsize(path)
+        content_range = byte_range.make_content_range(size)
+        if content_range is None:
+            response = current_app.response_class(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        response = _send_range(path, mimetype, content_range.start, content_range.stop - content_range.start)
+        response.content_range = content_range
+    else:
+        # 複数範囲の Range や、範囲に応えない場合 (事前圧縮版・If-Range の不一致) は Range を無視して全体を 200 で返す。
+        # conditional=True にすると send_file が Range を処理し、複数範囲には 416 を返してしまう。
+        # ETag・更新日時による 304 は最後の make_conditional で判定する
+        response = send_file(path, mimetype=mimetype, conditional=False, etag=False)
+    response.set_etag(f'{filename}-{asset_digest(path)}')
+    response.headers['Accept-Ranges'] = 'bytes'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.no_cache = None # send_file が付ける no-cache を外す
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    return response.make_conditional(request) if response.status_code == 200 else response
+
+@bp.route('/assets/<digest>/<path:filename>')
+def asset(digest, filename):
+    # ハッシュが古い (ファイルが更新された) 場合は長期キャッシュさせない
+    path = safe_join(current_app.static_folder, filename)
+    current = path is not None and os.path.isfile(path) and asset_digest(path) == digest
+    return serve_static_file(filename, immutable=current)
+
+@bp.cli.command('compress-assets')
+def compress_assets_command():
+    """static 以下のテキスト系ファイル (css/js など) の .gz と .br (brotli があれば) を作る。"""
+    static_folder = current_app.static_folder
+    count = 0
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != os.path.abspath(UPLOAD_FOLDER)]
+        for name in files:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            outputs = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                outputs.append(('.br', lambda d: brotli.compress(d, quality=11)))
+            for suffix, compress in outputs:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(compress(data))
+                os.replace(target + '.tmp', target)
+                count += 1
+    print(f'圧縮ファイルを作成しました: {count} 件' + ('' if brotli else ' (brotli が無いため gzip のみ)'))
+
+# 派生画像の生成
+# アップロードされた元画像はそのまま残し、表示サイズに合わせた JPEG/WebP を別フォルダに作る。
+# 生成は image_executor で行い、アップロードのリクエストは待たせない。
+_derived_ready = set() # 派生画像の存在を確認済みの元画像 (相対パス)
+
+def _upload_relpath(url):
+    # '/static/uploads/xxx.jpg' のようなURLを UPLOAD_FOLDER からの相対パスにする (対象外なら None)
+    prefix = f'{current_app.static_url_path}/uploads/'
+    if not url or not url.startswith(prefix):
+        return None
+    relpath = url[len(prefix):]
+    if relpath.startswith('derived/') or '..' in relpath.split('/'):
+        return None
+    return relpath
+
+def derivative_path(relpath, width, fmt):
+    stem = os.path.splitext(relpath)[0]
+    return os.path.join(DERIVED_FOLDER, f'{stem}-{width}.{DERIVATIVE_FORMATS[fmt]}')
+
+def generate_derivatives(source_path, force=False):
+    """元画像から各横幅の JPEG/WebP を生成する。メタデータ (EXIF 等) は引き継がない。"""
+    relpath = os.path.relpath(source_path, UPLOAD_FOLDER).replace(os.sep, '/')
+    with Image.open(source_path) as original:
+        original.seek(0) # アニメーションGIFは先頭フレームのみ
+        image = ImageOps.exif_transpose(original) # 回転情報を画素に反映してからEXIFを捨てる
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+
+    # 元画像より大きい幅は作らない (元画像が最小幅より小さい場合は最小幅の1枚のみ)
+    widths = [w for w in DERIVATIVE_WIDTHS if w <= image.width] or [DERIVATIVE_WIDTHS[0]]
+    for width in widths:
+        height = max(1, round(image.height * min(width, image.width) / image.width))
+        resized = image.resize((min(width, image.width), height), Image.LANCZOS)
+        for fmt in DERIVATIVE_FORMATS:
+            path = derivative_path(relpath, width, fmt)
+            if not force and os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            output = resized
+            if fmt == 'jpeg' and output.mode == 'RGBA':
+                # JPEGは透過できないため白背景に合成する
+                output = Image.new('RGB', resized.size, (255, 255, 255))
+                output.paste(resized, mask=resized.getchannel('A'))
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            output.save(tmp_path, format=fmt.upper(), quality=DERIVATIVE_QUALITY, optimize=True)
+            os.replace(tmp_path, path) # 書きかけのファイルを配信しないよう、完成してから置き換える
+    _derived_ready.add(relpath)
+    return len(widths)
+
+def _generate_derivatives_logged(source_path, force=False):
+    try:
+        return generate_derivatives(source_path, force)
+    except Exception:
+        logger.exception('派生画像の生成に失敗しました: %s', source_path)
+        return 0
+
+def schedule_derivatives(source_path, producer_id=None):
+    # バックグラウンドで派生画像を生成する (Pillowが無い場合は何もしない)
+    # 生成後は srcset を含めて描画し直すため、その生産者の断片キャッシュを無効にする
+    if Image is None:
+        return None
+    future = image_executor.submit(_generate_derivatives_logged, source_path)
+    if producer_id is not None:
+        future.add_done_callback(lambda _: invalidate_producer(producer_id))
+    return future
+
+@bp.app_template_global()
+def image_srcset(url, fmt='jpeg'):
+    """アップロード画像のURLから srcset 属性値を返す。派生画像がまだ無ければ空文字列。"""
+    relpath = _upload_relpath(url)
+    if relpath is None:
+        return ''
+    if relpath not in _derived_ready:
+        if not os.path.exists(derivative_path(relpath, DERIVATIVE_WIDTHS[0], 'webp')):
+            return ''
+        _derived_ready.add(relpath)
+    entries = []
+    for width in DERIVATIVE_WIDTHS:
+        path = derivative_path(relpath, width, fmt)
+        if width != DERIVATIVE_WIDTHS[0] and not os.path.exists(path):
+            break
+        filename = os.path.relpath(path, 'static').replace(os.sep, '/')
+        entries.append(f"{asset_url(filename)} {width}w")
+    return ', '.join(entries)
+
+@bp.cli.command('generate-image-derivatives')
+@click.option('--force', is_flag=True, help='既存の派生画像も作り直す')
+def generate_image_derivatives_command(force):
+    """既存のアップロード画像 (static/uploads 以下) の派生画像をまとめて生成する。"""
+    if Image is None:
+        print("Pillow library not found. Please install it with 'pip install Pillow'.")
+        return
+    sources = []
+    for root, dirs, files in os.walk(UPLOAD_FOLDER):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DERIVED_FOLDER]
+        sources.extend(os.path.join(root, f) for f in files if allowed_file(f))
+    futures = [image_executor.submit(_generate_derivatives_logged, path, force) for path in sources]
+    done = sum(1 for future in futures if future.result())
+    print(f'派生画像を生成しました: {done}/{len(sources)} 枚')
+
+# アップロードファイルの保存 (内容アドレス方式)
+# 受信中のファイルは UPLOAD_TMP_FOLDER に直接書き出しながら SHA-256 を計算し、
+# STORE_FOLDER/<先頭2文字>/<ハッシュ>.<拡張子> に移す。同じ画像は1つのファイルを共有し、
+# 参照数 (StoredUpload.ref_count) は商品・生産者の画像URLの変更に合わせてフラッシュ時に増減させる。
+# 参照が無くなったファイルは gc-uploads コマンドで削除する。
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_GC_GRACE_SECONDS = 60 * 60 # これより新しいファイルは保存処理中の可能性があるため消さない
+UPLOAD_EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+class HashingUploadFile:
+    """受信したファイルを一時ファイルに書きながら SHA-256 とサイズを求める。"""
+    def __init__(self):
+        os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_FOLDER, suffix='.part', delete=False)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class UploadRequest(Request):
+    # フォームのファイル部分をメモリに溜めず、HashingUploadFile に流し込む。
+    # 保存されなかった一時ファイルはリクエスト終了時に削除する
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingUploadFile()
+        self.__dict__.setdefault('upload_files', []).append(stream)
+        return stream
+
+    def close(self):
+        super().close()
+        for stream in self.__dict__.get('upload_files', ()):
+            stream.file.close()
+            if os.path.exists(stream.file.name):
+                os.remove(stream.file.name)
+
+def _upload_extension(filename):
+    ext = filename.rsplit('.', 1)[1].lower()
+    return UPLOAD_EXTENSION_ALIASES.get(ext, ext)
+
+def store_upload(file_storage):
+    """アップロードされたファイルを内容のハッシュ名で保存し、(URL, 保存先のパス) を返す。
+    同じ内容のファイルが既にあれば、そのファイルを使う。"""
+    stream = file_storage.stream
+    if not isinstance(stream, HashingUploadFile):
+        # 独自の Request を経由しない場合 (テストクライアントなど)
+        return store_stream(stream, file_storage.filename)
+    stream.file.flush()
+    return _store_hashed(stream.file.name, stream.sha256.hexdigest(), file_storage.filename)
+
+def store_stream(stream, filename):
+    """読み込み可能なストリーム (zip内のファイルなど) を、書き出しながらハッシュを求めて保存する。"""
+    os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_FOLDER, suffix='.part', delete=False) as f:
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            f.write(chunk)
+    return _store_hashed(f.name, sha256.hexdigest(), filename)
+
+def _store_hashed(tmp_path, digest, filename):
+    relpath = f'cas/{digest[:2]}/{digest}.{_upload_extension(filename)}'
+    path = os.path.join(UPLOAD_FOLDER, relpath)
+    try:
+        # 既存のファイルを使い回す場合は更新日時を新しくし、参照を記録するまでの間に gc-uploads に消されないようにする
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        os.chmod(path, 0o644)
+    else:
+        os.remove(tmp_path)
+    return f'{current_app.static_url_path}/uploads/{relpath}', path
+
+def _stored_upload_path(url):
+    relpath = _upload_relpath(url)
+    return relpath if relpath and relpath.startswith('cas/') else None
+
+# 画像URLを持つ列。この列の値の変化に合わせて参照数を増減させる
+UPLOAD_REFERENCE_COLUMNS = (('Product', 'image_url'), ('Producer', 'profile_image'))
+
+@event.listens_for(RoutingSession, 'after_flush')
+def update_upload_references(session, flush_context):
+    deltas = defaultdict(int)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        for model_name, column in UPLOAD_REFERENCE_COLUMNS:
+            if type(obj).__name__ != model_name:
+                continue
+            history = inspect(obj).attrs[column].history
+            if obj in session.deleted:
+                removed, added = list(history.unchanged) + list(history.deleted), []
+            else:
+                removed, added = history.deleted, history.added
+            for url in removed:
+                deltas[url] -= 1
+            for url in added:
+                deltas[url] += 1
+    adjust_upload_references(session.connection(), deltas)
+
+def adjust_upload_references(connection, deltas):
+    """{画像URL: 参照数の増減} を StoredUpload に反映する。ORM を通さない一括登録からも使う。"""
+    deltas = {path: n for path, n in
+              ((_stored_upload_path(url), n) for url, n in deltas.items() if n) if path}
+    table = StoredUpload.__table__
+    for path, delta in deltas.items():
+        if delta > 0:
+            full_path = os.path.join(UPLOAD_FOLDER, path)
+            size = os.path.getsize(full_path) if os.path.exists(full_path) else 0
+            stmt = dialect_insert(StoredUpload).values(path=path, size=size, ref_count=delta)
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.path], set_={'ref_count': table.c.ref_count + delta}))
+        else:
+            connection.execute(table.update().where(table.c.path == path)
+                               .values(ref_count=table.c.ref_count + delta))
+            connection.execute(table.delete().where(table.c.path == path, table.c.ref_count <= 0))
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(error):
+    limit_mb = current_app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024)
+    message = f'ファイルが大きすぎます。{limit_mb:g}MB以下にしてください。'
+    if request.path.startswith('/api/'):
+        return jsonify({'status': 'error', 'message': message}), 413
+    return current_app.response_class(message, status=413, mimetype='text/plain')
+
+@bp.cli.command('gc-uploads')
+@click.option('--dry-run', is_flag=True, help='削除せずに対象を表示する')
+def gc_uploads_command(dry_run):
+    """どこからも参照されていない保存ファイル (と派生画像) を削除する。"""
+    referenced = set(db.session.scalars(select(StoredUpload.path).where(StoredUpload.ref_count > 0)))
+    cutoff = time.time() - UPLOAD_GC_GRACE_SECONDS
+    removed = 0
+    # static/uploads/tmp は以前の受信中ファイルの置き場所 (残っていれば片付ける)
+    for folder in (STORE_FOLDER, UPLOAD_TMP_FOLDER, os.path.join(UPLOAD_FOLDER, 'tmp')):
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/')
+                if relpath in referenced or os.path.getmtime(path) > cutoff:
+                    continue
+                targets = [path]
+                if folder == STORE_FOLDER:
+                    targets += [derivative_path(relpath, w, fmt) for w in DERIVATIVE_WIDTHS for fmt in DERIVATIVE_FORMATS]
+                for target in targets:
+                    if os.path.exists(target):
+                        if dry_run:
+                            print(target)
+                        else:
+                            os.remove(target)
+                _derived_ready.discard(relpath)
+                removed += 1
+    print(f'参照されていないファイル: {removed} 件' + (' (dry-run)' if dry_run else ' を削除しました'))
+
+# 商品の一括登録 (CSV/JSONL)
+# 1行ずつ読みながら検証し、IMPORT_BATCH_SIZE 件ごとにまとめて INSERT して commit する。
+# 画像は同梱の zip 内のファイル名で指定し、同じ名前の画像は1回だけ保存する。
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 1000 # レポートに含めるエラーの最大件数 (件数自体はすべて数える)
+MAX_PRICE = 10_000_000 # 価格の上限 (円)。DBの整数型に収まらない値で一括登録全体が失敗しないようにする
+IMPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+def import_format(filename, explicit=None):
+    # 明示された形式が無ければ拡張子から判定する (判定できなければ None)
+    if explicit:
+        return explicit if explicit in IMPORT_FORMATS.values() else None
+    return IMPORT_FORMATS.get(os.path.splitext(filename or '')[1].lower())
+
+def iter_import_records(binary_file, fmt):
+    """(行番号, レコード, エラー) を1行ずつ返す。"""
+    text_file = io.TextIOWrapper(binary_file, encoding='utf-8-sig', newline='')
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(text_file)
+            for record in reader:
+                yield reader.line_num, record, None
+        else:
+            for line_no, line in enumerate(text_file, 1):
+                if not line.strip():
+                    continue
                 try:
-                    font = ImageFont.truetype("arial.ttf", 80) # Windows
-                except IOError:
-                    try:
-                        font = ImageFont.truetype("/Library/Fonts/Arial.ttf", 80) # macOS
-                    except IOError:
-                        font = ImageFont.load_default() # Fallback
-                
-                text = "P" # ProducerのP
-                text_bbox = d.textbbox((0,0), text, font=font)
-                text_width = text_bbox[2] - text_bbox[0]
-                text_height = text_bbox[3] - text_bbox[1]
-                
-                x = (400 - text_width) / 2
-                y = (400 - text_height) / 2
-                d.text((x, y), text, fill=(255, 255, 255), font=font)
-                img.save(default_profile_image_path)
-            except ImportError:
-                print("Pillow library not found. Please install it with 'pip install Pillow' to generate default image.")
-                # Pillowがない場合は、手動で画像を配置するか、他のデフォルトURLを設定
-                # 仮のURLを設定し、ユーザーに手動で画像をアップロードしてもらう
-                pass 
-        
-        profile_image_url = url_for('static', filename=f'uploads/{default_profile_image_filename}') if os.path.exists(default_profile_image_path) else 'https://via.placeholder.com/120/CCCCCC/FFFFFF?text=No+Image'
+                    record = json.loads(line)
+                except ValueError:
+                    yield line_no, None, 'JSONとして読み込めません。'
+                    continue
+                if not isinstance(record, dict):
+                    yield line_no, None, '1行に1つのオブジェクトを指定してください。'
+                    continue
+                yield line_no, record, None
+    except UnicodeDecodeError:
+        yield None, None, 'ファイルは UTF-8 で保存してください。'
+    finally:
+        text_file.detach() # 元のファイルは呼び出し側で閉じる
+
+def validate_import_record(record):
+    """レコードを (name, price, description, image) に変換する。不正ならエラーメッセージを返す。"""
+    name = str(record.get('name') or '').strip()
+    description = str(record.get('description') or '').strip()
+    image = str(record.get('image') or '').strip()
+    price = record.get('price')
+    if not name or not description:
+        return None, 'name と description は必須です。'
+    if len(name) > 100:
+        return None, 'name は100文字以内にしてください。'
+    if len(description) > 500:
+        return None, 'description は500文字以内にしてください。'
+    if isinstance(price, str) and price.strip().isdigit():
+        price = int(price)
+    if isinstance(price, bool) or not isinstance(price, int) or price < 0:
+        return None, 'price は0以上の整数にしてください。'
+    if price > MAX_PRICE:
+        return None, f'price は{MAX_PRICE}以下にしてください。'
+    if image and not allowed_file(image):
+        return None, '画像の形式はpng, jpg, jpeg, gifのいずれかにしてください。'
+    return (name, price, description, image), None
+
+def import_products(producer_id, rows_file, fmt, images_zip=None, max_image_size=None):
+    """CSV/JSONL の商品をまとめて登録し、{'imported', 'error_count', 'errors'} を返す。"""
+    report = {'imported': 0, 'error_count': 0, 'errors': []}
+    archive = zipfile.ZipFile(images_zip) if images_zip else None
+    image_urls = {} # zip内の画像名 -> (URL, エラー)
+    stored_paths = set()
+    batch = []
+
+    def add_error(line_no, message):
+        report['error_count'] += 1
+        if len(report['errors']) < MAX_IMPORT_ERRORS:
+            report['errors'].append({'row': line_no, 'message': message})
+
+    def resolve_image(name):
+        if name not in image_urls:
+            try:
+                info = archive.getinfo(name) if archive else None
+            except KeyError:
+                info = None
+            if info is None:
+                image_urls[name] = (None, f'画像 {name} が zip に含まれていません。')
+            elif max_image_size is not None and info.file_size > max_image_size:
+                image_urls[name] = (None, f'画像 {name} が大きすぎます。')
+            else:
+                with archive.open(info) as member:
+                    url, path = store_stream(member, name)
+                stored_paths.add(path)
+                image_urls[name] = (url, None)
+        return image_urls[name]
+
+    def flush_batch():
+        # RETURNING を付けると1行ずつの INSERT になるため、executemany で入れてから id を読み直す
+        last_id = db.session.scalar(select(func.max(Product.id))) or 0
+        db.session.execute(insert(Product.__table__), batch)
+        product_ids = db.session.scalars(select(Product.id).where(
+            Product.producer_id == producer_id, Product.id > last_id)).all()
+        image_refs = defaultdict(int)
+        for row in batch:
+            if row['image_url']:
+                image_refs[row['image_url']] += 1
+        adjust_upload_references(db.session.connection(), image_refs)
+        index_products(product_ids)
+        db.session.commit()
+        report['imported'] += len(batch)
+        batch.clear()
+
+    try:
+        for line_no, record, error in iter_import_records(rows_file, fmt):
+            if error is None:
+                values, error = validate_import_record(record)
+            if error is None and values[3]:
+                image_url, error = resolve_image(values[3])
+            else:
+                image_url = None
+            if error is not None:
+                add_error(line_no, error)
+                continue
+            name, price, description, _ = values
+            batch.append({'name': name, 'price': price, 'description': description,
+                          'image_url': image_url, 'producer_id': producer_id})
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush_batch()
+        if batch:
+            flush_batch()
+    finally:
+        if archive:
+            archive.close()
+        db.session.rollback() # 途中で失敗した場合、commit 前のチャンクは取り消す
+
+    if report['imported']:
+        invalidate_producer(producer_id)
+        event_broker.publish(CATALOG_CHANNEL, 'products', {'producer_id': producer_id, 'count': report['imported']})
+    for path in stored_paths:
+        schedule_derivatives(path, producer_id)
+    return report
+
+@bp.cli.command('import-products')
+@click.argument('producer_username')
+@click.argument('rows_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', 'images_path', type=click.Path(exists=True, dir_okay=False), help='画像をまとめた zip')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='省略時は拡張子から判定する')
+def import_products_command(producer_username, rows_path, images_path, fmt):
+    """CSV/JSONL の商品を指定した生産者の商品としてまとめて登録する。
+    列: name, price, description, image (zip内の画像ファイル名。省略可)"""
+    producer = Producer.query.filter_by(username=producer_username).first()
+    if producer is None:
+        raise click.ClickException(f'生産者 {producer_username} が見つかりません。')
+    fmt = import_format(rows_path, fmt)
+    if fmt is None:
+        raise click.ClickException('形式を判定できません。--format を指定してください。')
+    start = time.perf_counter()
+    with open(rows_path, 'rb') as rows_file:
+        images_zip = open(images_path, 'rb') if images_path else None
+        try:
+            report = import_products(producer.id, rows_file, fmt, images_zip)
+        finally:
+            if images_zip:
+                images_zip.close()
+    for error in report['errors']:
+        print(f"{error['row']}行目: {error['message']}")
+    print(f"{report['imported']} 件を登録しました (エラー {report['error_count']} 件, "
+          f"{time.perf_counter() - start:.1f} 秒)")
+
+# 商品カタログのスナップショット
+# 商品一覧の検索・並べ替えをブラウザ内で行えるよう、全商品を1つの圧縮済みJSONにして static/catalog に書き出す。
+# ファイル名は内容のハッシュで、/assets 経由で長期キャッシュされる。最新のファイル名は CATALOG_POINTER に書く。
+# 作り直すのは、CATALOG_BUILDER_LOCK のロックを取れた1つのプロセス (ワーカー) だけ。そのプロセスが
+# CATALOG_SNAPSHOT_DELAY 秒ごとに共有のカタログのバージョン (FragmentVersion) を確認し、前回作った時から
+# 変わっていればバックグラウンドで作り直す。どのプロセス (import-products などのコマンドを含む) での変更も、
+# 同じプロセスがまとめて反映する。ロックを持つプロセスが終了すると、他のプロセスが引き継ぐ。
+CATALOG_FOLDER = os.path.join('static', 'catalog')
+CATALOG_POINTER = os.path.join(CATALOG_FOLDER, 'current')
+CATALOG_BUILT_VERSION = os.path.join(CATALOG_FOLDER, 'current.version') # 最新のスナップショットを作った時のバージョン
+CATALOG_BUILDER_LOCK = os.path.join('instance', 'catalog_builder.lock')
+CATALOG_SNAPSHOT_DELAY = float(os.environ.get('CATALOG_SNAPSHOT_DELAY', '2')) # 秒
+CATALOG_SNAPSHOT_KEEP = 3 # 古いページから参照される可能性があるため、直近の数世代は残す
+CATALOG_PRODUCT_FIELDS = ['id', 'name', 'price', 'description', 'image_url', 'image_srcset', 'producer_id']
+
+def build_catalog_snapshot():
+    """スナップショットを書き出し、(ファイル名, 商品数) を返す。商品は id 順に一定件数ずつ読む。"""
+    os.makedirs(CATALOG_FOLDER, exist_ok=True)
+    producers = [[producer_id, account_name, media_url(profile_image)] for producer_id, account_name, profile_image
+                 in db.session.query(Producer.id, Producer.account_name, Producer.profile_image).order_by(Producer.id)]
+    sha256 = hashlib.sha256()
+    tmp_path = os.path.join(CATALOG_FOLDER, f'.{uuid.uuid4().hex}.tmp')
+    count = 0
+    with open(tmp_path, 'wb') as raw, gzip.GzipFile(tmp_path + '.gz', 'wb', compresslevel=9, mtime=0) as compressed:
+        def write(text):
+            data = text.encode('utf-8')
+            sha256.update(data)
+            raw.write(data)
+            compressed.write(data)
+
+        dumps = lambda value: json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        write(f'{{"fields":{dumps(CATALOG_PRODUCT_FIELDS)},"producers":{dumps(producers)},"products":[')
+        last_id = 0
+        while True:
+            rows = db.session.query(Product.id, Product.name, Product.price, Product.description,
+                                    Product.image_url, Product.producer_id) \
+                .filter(Product.id > last_id).order_by(Product.id).limit(SEARCH_REBUILD_BATCH).all()
+            if not rows:
+                break
+            write((',' if count else '') + ','.join(
+                dumps([product_id, name, price, description, media_url(image_url), image_srcset(image_url), producer_id])
+                for product_id, name, price, description, image_url, producer_id in rows))
+            count += len(rows)
+            last_id = rows[-1][0]
+        write(']}')
+
+    filename = f'catalog-{sha256.hexdigest()[:16]}.json'
+    path = os.path.join(CATALOG_FOLDER, filename)
+    os.replace(tmp_path, path)
+    os.replace(tmp_path + '.gz', path + '.gz') # .gz の方が新しい更新日時になるよう後に置く
+    with open(CATALOG_POINTER + '.tmp', 'w') as f:
+        f.write(filename)
+    os.replace(CATALOG_POINTER + '.tmp', CATALOG_POINTER)
+
+    snapshots = sorted((name for name in os.listdir(CATALOG_FOLDER) if name.startswith('catalog-') and name.endswith('.json')),
+                       key=lambda name: os.path.getmtime(os.path.join(CATALOG_FOLDER, name)), reverse=True)
+    for name in snapshots[CATALOG_SNAPSHOT_KEEP:]:
+        for old in (name, name + '.gz'):
+            if os.path.exists(os.path.join(CATALOG_FOLDER, old)):
+                os.remove(os.path.join(CATALOG_FOLDER, old))
+    return filename, count
+
+class CatalogSnapshot:
+    """スナップショットを作り直す。作り直しはロックを取れた1つのプロセスのバックグラウンドのスレッドで行う。"""
+    def __init__(self, delay):
+        self.delay = delay
+        self.app = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock() # 作り直しは同時に1つだけ
+        self._wake = threading.Event()
+        self._watcher = None
+        self._lock_file = None # ロックを取れたら、プロセスが終わるまで開いたままにする
+        self._pool = CpuPool(1, 'catalog')
+        self._current = (None, None) # (CATALOG_POINTER の更新日時, ファイル名)
+
+    def init_app(self, app):
+        self.app = app
+
+    def schedule(self):
+        """変更があったことを知らせる。作り直しを担当するプロセスなら、次の確認を早める。"""
+        self._wake.set()
+
+    def _start_watcher(self):
+        # Webのプロセスでスナップショットが初めて参照された時に始める (コマンドのプロセスでは作り直さない)
+        with self._lock:
+            if self.app is None or self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, name='catalog-snapshot', daemon=True)
+            self._watcher.start()
+
+    def _acquire_builder_lock(self):
+        if self._lock_file is not None:
+            return True
+        if fcntl is None:
+            return True # ファイルロックが使えない環境では各プロセスで作る
+        os.makedirs(os.path.dirname(CATALOG_BUILDER_LOCK), exist_ok=True)
+        lock_file = open(CATALOG_BUILDER_LOCK, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _watch(self):
+        while True:
+            # 変更の通知があっても少し待ち、続けて起きる変更をまとめて1回で作り直す
+            if self._wake.wait(self.delay):
+                time.sleep(self.delay)
+            self._wake.clear()
+            try:
+                if self._acquire_builder_lock() and self._stale():
+                    self.build()
+            except Exception:
+                logger.exception('カタログのスナップショットの作成に失敗しました')
+
+    def _current_version(self):
+        with self.app.app_context():
+            return fragment_cache.version('catalog')
+
+    def _stale(self):
+        try:
+            with open(CATALOG_BUILT_VERSION) as f:
+                built = int(f.read().strip())
+        except (OSError, ValueError):
+            return True
+        return built != self._current_version() or not os.path.exists(CATALOG_POINTER)
+
+    def build(self):
+        """スナップショットを作り直し、(ファイル名, 件数) を返す。作り始めた時点のバージョンを記録する。"""
+        with self._build_lock:
+            version = self._current_version()
+            # gevent の下でもイベントループを止めないよう、作成は CPU 用のプールで行う
+            result = self._pool.submit(self._build).result()
+            with open(CATALOG_BUILT_VERSION + '.tmp', 'w') as f:
+                f.write(str(version))
+            os.replace(CATALOG_BUILT_VERSION + '.tmp', CATALOG_BUILT_VERSION)
+            return result
+
+    def _build(self):
+        # URL (media_url / image_srcset) を組み立てるためリクエストコンテキストを用意する
+        with self.app.test_request_context():
+            return build_catalog_snapshot()
+
+    def filename(self):
+        """最新のスナップショットのファイル名。まだ無ければ None を返す。"""
+        self._start_watcher()
+        try:
+            mtime = os.path.getmtime(CATALOG_POINTER)
+        except OSError:
+            return None
+        if self._current[0] != mtime:
+            with open(CATALOG_POINTER) as f:
+                self._current = (mtime, f.read().strip())
+        return self._current[1]
+
+catalog_snapshot = CatalogSnapshot(CATALOG_SNAPSHOT_DELAY)
+
+@bp.app_template_global()
+def catalog_snapshot_url():
+    filename = catalog_snapshot.filename()
+    if not filename or not os.path.exists(os.path.join(CATALOG_FOLDER, filename)):
+        return None
+    return asset_url(f'catalog/{filename}')
+
+@bp.cli.command('build-catalog-snapshot')
+def build_catalog_snapshot_command():
+    """商品カタログのスナップショット (static/catalog) を作り直す。"""
+    filename, count = catalog_snapshot.build()
+    print(f'{filename} を作成しました ({count} 件)。')
+
+# 変更の通知 (Server-Sent Events)
+# /api/events に接続したブラウザへ、新しい商品の出品 (catalog) と自分のカートの変更 (cart:<消費者ID>) を送る。
+# 接続ごとにキューを持ち、commit 後に publish されたイベントを待つ。待機中はスレッドを占有するため、
+# 多数の接続を受ける場合は gevent のワーカーで起動する (gunicorn -k gevent 'server:create_app()')。
+# 同期ワーカーやスレッドプール (gthread, waitress など) では接続がワーカー/スレッドを占有し続けるため、
+# SSE_ENABLED=auto (既定) なら gevent で動いている時だけ受け付ける。SSE_ENABLED=1 で明示的に有効にした場合は、
+# 通常のリクエストを処理するスレッドが残るよう、同時接続数を SSE_THREAD_MAX_CONNECTIONS に抑える
+# (ワーカーのスレッド数より小さくすること)。
+# EVENT_BROKER_URL (redis://...) を設定すると Redis の pub/sub を経由し、複数のプロセス間でイベントを共有する。
+CATALOG_CHANNEL = 'catalog'
+SSE_MAX_CONNECTIONS = int(os.environ.get('SSE_MAX_CONNECTIONS', '1000')) # 1プロセスあたりの同時接続数 (gevent)
+SSE_THREAD_MAX_CONNECTIONS = int(os.environ.get('SSE_THREAD_MAX_CONNECTIONS', '2')) # gevent 以外での同時接続数
+SSE_HEARTBEAT_SECONDS = 15 # 切断を検知するためのコメント行の送信間隔
+SSE_RETRY_MS = 3000 # 切断時にブラウザが再接続するまでの時間
+SSE_QUEUE_SIZE = 100 # 読み出しが追いつかない接続は、これ以上溜めずに切断する (再接続させる)
+EVENT_BROKER_PREFIX = 'marche:events:'
+
+class Subscription:
+    def __init__(self, channels):
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+        self.closed = False
+
+class EventBroker:
+    """プロセス内の購読者にイベントを配る。Redis を設定した場合は Redis 経由で全プロセスに配る。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set) # チャンネル -> Subscription
+        self._count = 0
+        self._redis = None
+        self._listener = None
+
+    def init_app(self, app):
+        url = app.config['EVENT_BROKER_URL']
+        if url:
+            if redis is None:
+                raise RuntimeError("EVENT_BROKER_URL を使うには redis をインストールしてください (pip install redis)。")
+            self._redis = redis.Redis.from_url(url)
+
+    def subscribe(self, channels, max_connections=SSE_MAX_CONNECTIONS):
+        """購読を始める。同時接続数が max_connections に達していれば None を返す。"""
+        subscription = Subscription(channels)
+        with self._lock:
+            if self._count >= max_connections:
+                return None
+            self._count += 1
+            for channel in channels:
+                self._subscriptions[channel].add(subscription)
+            if self._redis is not None and self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='event-broker', daemon=True)
+                self._listener.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """購読をやめる。レスポンスの close と送信の終了の両方から呼ばれるため、2回目以降は何もしない。"""
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._count -= 1
+            for channel in subscription.channels:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+    def publish(self, channel, event, data):
+        # commit 後に呼ぶ。通知の失敗でリクエスト自体は失敗させない
+        message = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        try:
+            if self._redis is not None:
+                self._redis.publish(EVENT_BROKER_PREFIX + channel, json.dumps([event, message]))
+            else:
+                self.deliver(channel, event, message)
+        except Exception:
+            logger.exception('イベントの通知に失敗しました: %s', channel)
+
+    def deliver(self, channel, event, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait((event, message))
+            except queue.Full:
+                subscription.overflowed = True
+
+    def _listen(self):
+        # Redis から受け取ったイベントを、このプロセスの購読者に配る。切断されたら少し待って繋ぎ直す
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(EVENT_BROKER_PREFIX + '*')
+                for item in pubsub.listen():
+                    channel = item['channel'].decode()[len(EVENT_BROKER_PREFIX):]
+                    event, message = json.loads(item['data'])
+                    self.deliver(channel, event, message)
+            except Exception:
+                logger.exception('イベントの受信が中断しました。再接続します')
+                time.sleep(1)
+
+event_broker = EventBroker()
+
+def publish_cart_changed(consumer_id, version):
+    # 同じ消費者の他のタブ・端末にカートの変更を知らせる (内容は /api/cart/summary で取り直す)
+    event_broker.publish(f'cart:{consumer_id}', 'cart', {'version': version})
+
+@bp.app_template_global()
+def events_enabled():
+    """このプロセスで /api/events の長時間接続を受け付けるか。"""
+    setting = current_app.config['SSE_ENABLED']
+    if setting != 'auto':
+        return setting in (True, '1', 'true', 'on')
+    return running_under_gevent()
+
+@bp.route('/api/events')
+def event_stream():
+    if not events_enabled():
+        # 204 を返すと EventSource は再接続をやめる
+        return '', 204
+    channels = [CATALOG_CHANNEL]
+    if 'consumer_id' in session:
+        channels.append(f"cart:{session['consumer_id']}")
+    subscription = event_broker.subscribe(
+        channels, SSE_MAX_CONNECTIONS if running_under_gevent() else SSE_THREAD_MAX_CONNECTIONS)
+    if subscription is None:
+        response = current_app.response_class('接続数が上限に達しています。', status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = '30'
+        return response
+    # リクエストコンテキスト (DB接続を含む) はレスポンスを返した時点で解放され、送信中は保持しない
+    def generate():
+        try:
+            yield f'retry: {SSE_RETRY_MS}\n\n'
+            while not subscription.overflowed:
+                try:
+                    event, message = subscription.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'event: {event}\ndata: {message}\n\n'
+        finally:
+            event_broker.unsubscribe(subscription)
+    response = current_app.response_class(generate(), mimetype='text/event-stream')
+    # 本文を読まずに終わったレスポンス (HEAD など) では generate() が始まらないため、close でも購読を解除する
+    response.call_on_close(lambda: event_broker.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx にバッファさせない
+    return response
+
+# 商品一覧のページング設定 (キーセット方式)
+PRODUCTS_PER_PAGE = 24 # 1ページあたりの商品数
+MAX_PRODUCTS_PER_PAGE = 100 # APIで指定できる最大件数
+# 並べ替えキー -> (ソート列名, 降順かどうか)。index.html / script.js の並べ替えに対応
+PRODUCT_SORTS = {
+    'default': (None, False),
+    'price-asc': ('price', False),
+    'price-desc': ('price', True),
+    'name-asc': ('name', False),
+    'name-desc': ('name', True),
+}
+# 並べ替え列の最小値 (価格は0以上に制限している)。先頭ページもこの値からの範囲としてインデックスを読む
+PRODUCT_SORT_MINIMUMS = {'price': 0, 'name': ''}
+
+def encode_cursor(values):
+    # 最後に表示した行のソートキーを、URLに載せられる不透明な文字列にする
+    raw = json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+# DBに渡せる整数の範囲 (符号付き64ビット)。これを超える値は SQLite に渡すと OverflowError になる
+SQL_INT_MIN = -2 ** 63
+SQL_INT_MAX = 2 ** 63 - 1
+
+def _is_sql_int(value):
+    return type(value) is int and SQL_INT_MIN <= value <= SQL_INT_MAX
+
+def decode_cursor(cursor):
+    # 不正なカーソルは None を返し、呼び出し側で先頭ページとして扱う
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or not values or not _is_sql_int(values[-1]):
+        return None
+    return values
+
+def page_position(sort, cursor):
+    """カーソルが指す前ページ最後の (ソート列, id) または (id,) を返す。先頭ページや不正なカーソルなら None。
+    ソート値の型が列と合わない、または整数がDBで扱えない範囲のカーソル (細工されたもの) も不正として扱う。"""
+    column_name, _ = PRODUCT_SORTS.get(sort, PRODUCT_SORTS['default'])
+    last = decode_cursor(cursor) if cursor else None
+    if not last:
+        return None
+    if column_name:
+        python_type = getattr(Product, column_name).type.python_type
+        if len(last) == 2 and type(last[0]) is python_type and (python_type is not int or _is_sql_int(last[0])):
+            return tuple(last)
+    elif len(last) == 1:
+        return tuple(last)
+    return None
+
+def fetch_product_page(sort='default', cursor=None, limit=PRODUCTS_PER_PAGE):
+    """商品を1ページ分取得する。OFFSET を使わず、前ページ最後の (ソート列, id) より後ろだけを読むため、
+    何ページ目でもカタログ全体の件数に関係なく同じコストで済む。
+    戻り値は (商品リスト, 次ページのカーソル or None)。"""
+    column_name, descending = PRODUCT_SORTS.get(sort, PRODUCT_SORTS['default'])
+    query = Product.query.options(db.joinedload(Product.producer))
+    last = page_position(sort, cursor)
+
+    if column_name:
+        column = getattr(Product, column_name)
+        if last:
+            # 行値の比較にすると (列, id) のインデックスを位置 (列>?) から読み始められる。
+            # OR で書くと先頭からのインデックス走査になり、深いページほど遅くなる
+            key = db.tuple_(column, Product.id)
+            query = query.filter(key < last if descending else key > last)
+        else:
+            query = query.filter(column >= PRODUCT_SORT_MINIMUMS[column_name])
+        if descending:
+            query = query.order_by(column.desc(), Product.id.desc())
+        else:
+            query = query.order_by(column.asc(), Product.id.asc())
+    else:
+        query = query.filter(Product.id > (last[0] if last else 0))
+        query = query.order_by(Product.id.asc())
+
+    # 1件多く読んで次ページの有無を判定する
+    products = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        tail = products[-1]
+        if column_name:
+            next_cursor = encode_cursor([getattr(tail, column_name), tail.id])
+        else:
+            next_cursor = encode_cursor([tail.id])
+    return products, next_cursor
+
+def product_to_dict(product):
+    producer = product.producer
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': product.price,
+        'description': product.description,
+        'image_url': media_url(product.image_url),
+        'image_srcset': image_srcset(product.image_url),
+        'producer': {
+            'id': producer.id,
+            'account_name': producer.account_name,
+            'profile_image': media_url(producer.profile_image),
+        } if producer else None,
+    }
+
+# 商品検索 (SQLite FTS5)
+# 日本語は単語の区切りが無いため、文字列を2文字ずつ (bigram) に分割した形で FTS5 に格納する。
+# 検索語も同じように分割してフレーズ検索するので、部分一致を転置インデックスで引ける。
+SEARCH_TABLE = 'product_search'
+SEARCH_WEIGHTS = (10.0, 1.0, 3.0) # name, description, producer_name の重み (bm25)
+SEARCH_REBUILD_BATCH = 5000
+_SEARCH_WORD_RE = re.compile(r'\w+')
+
+def search_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def to_bigrams(value):
+    # NFKC で全角英数を半角に揃え、語ごとに2文字ずつずらしたトークン列にする
+    words = _SEARCH_WORD_RE.findall(unicodedata.normalize('NFKC', value or '').lower())
+    tokens = []
+    for word in words:
+        if len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return ' '.join(tokens)
+
+def build_match_query(q):
+    # 検索語の各語を bigram のフレーズにし、AND で結ぶ。1文字の語は前方一致にする
+    words = _SEARCH_WORD_RE.findall(unicodedata.normalize('NFKC', q or '').lower())
+    phrases = []
+    for word in words:
+        if len(word) == 1:
+            phrases.append(f'"{word}"*')
+        else:
+            phrases.append('"' + ' '.join(word[i:i + 2] for i in range(len(word) - 1)) + '"')
+    return ' AND '.join(phrases)
+
+def ensure_search_index():
+    """検索用の仮想テーブルを作成する。新しく作った場合は True を返す。"""
+    if not search_enabled():
+        return False
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': SEARCH_TABLE}).first()
+    if exists:
+        return False
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(name, description, producer_name, tokenize='unicode61')"))
+    db.session.commit()
+    return True
+
+def _search_rows(rows):
+    return [{'rowid': product_id, 'name': to_bigrams(name), 'description': to_bigrams(description),
+             'producer_name': to_bigrams(producer_name)}
+            for product_id, name, description, producer_name in rows]
+
+def index_products(product_ids):
+    """指定した商品の検索インデックスを作り直す。呼び出し側の commit で確定する。"""
+    if not search_enabled() or not product_ids:
+        return
+    rows = db.session.query(Product.id, Product.name, Product.description, Producer.account_name) \
+        .join(Producer, Product.producer_id == Producer.id) \
+        .filter(Product.id.in_(product_ids)).all()
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({','.join(str(int(i)) for i in product_ids)})"))
+    if rows:
+        db.session.execute(text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, description, producer_name) "
+            "VALUES (:rowid, :name, :description, :producer_name)"), _search_rows(rows))
+
+def index_producer_products(producer_id):
+    # 生産者名が変わると、その生産者の全商品の producer_name 列を更新する必要がある
+    product_ids = [product_id for (product_id,) in
+                   db.session.query(Product.id).filter(Product.producer_id == producer_id)]
+    for start in range(0, len(product_ids), SEARCH_REBUILD_BATCH):
+        index_products(product_ids[start:start + SEARCH_REBUILD_BATCH])
+
+def rebuild_search_index():
+    """検索インデックスを全件作り直す。id 順に一定件数ずつ読み、メモリ使用量を抑える。"""
+    if not search_enabled():
+        return 0
+    ensure_search_index()
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    count = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Product.id, Product.name, Product.description, Producer.account_name) \
+            .join(Producer, Product.producer_id == Producer.id) \
+            .filter(Product.id > last_id).order_by(Product.id).limit(SEARCH_REBUILD_BATCH).all()
+        if not rows:
+            break
+        db.session.execute(text(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, description, producer_name) "
+            "VALUES (:rowid, :name, :description, :producer_name)"), _search_rows(rows))
+        count += len(rows)
+        last_id = rows[-1][0]
+    db.session.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')"))
+    db.session.commit()
+    return count
+
+def search_products(q, limit=PRODUCTS_PER_PAGE, offset=0):
+    """関連度順に商品を検索する。戻り値は (商品リスト, 次ページがあるか)。"""
+    match = build_match_query(q)
+    if not match:
+        return [], False
+    if search_enabled():
+        weights = ', '.join(str(w) for w in SEARCH_WEIGHTS)
+        ids = [row[0] for row in db.session.execute(text(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match "
+            f"ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT :limit OFFSET :offset"),
+            {'match': match, 'limit': limit + 1, 'offset': offset})]
+    else:
+        # FTS5 が使えないDBでは部分一致で代用する (関連度順ではない)
+        pattern = f'%{q}%'
+        ids = [row[0] for row in db.session.query(Product.id)
+               .filter(db.or_(Product.name.ilike(pattern), Product.description.ilike(pattern)))
+               .order_by(Product.id).limit(limit + 1).offset(offset)]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    products = {p.id: p for p in Product.query.options(db.joinedload(Product.producer))
+                .filter(Product.id.in_(ids))} if ids else {}
+    return [products[i] for i in ids if i in products], has_more
+
+@bp.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """商品検索インデックスを全件作り直す。"""
+    count = rebuild_search_index()
+    print(f'検索インデックスを再構築しました: {count} 件')
+
+# スキーマのマイグレーション
+# create_all() は既存のテーブルを変更しないため、既存DBへの変更 (インデックスの追加など) は
+# ここに番号順に登録し、init-db / migrate-db で未適用のものだけを1つずつ commit しながら実行する。
+# create_all() で作れないもの (全文検索の仮想テーブルなど) もここで作るため、新しいDBでもすべて実行する。
+# どのマイグレーションも、既に適用された状態のDBに対して実行しても問題ないように書く。
+MIGRATIONS = [] # (番号, 説明, 関数)
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+def _create_indexes(model, *names):
+    # モデルに宣言したインデックスのうち、まだ無いものを作る
+    indexes = {index.name: index for index in model.__table__.indexes}
+    for name in names:
+        indexes[name].create(db.session.connection(), checkfirst=True)
+
+@migration(1, 'カートの (consumer_id, product_id) を一意にする')
+def migrate_cart_unique_index():
+    # 一意制約が無い既存のDBでは、重複行の数量を合算してから一意インデックスを作る
+    indexes = inspect(db.session.connection()).get_indexes('cart_item')
+    if any(index['name'] == 'uq_cart_item_consumer_product' for index in indexes):
+        return
+    db.session.execute(text(
+        "UPDATE cart_item SET quantity = (SELECT SUM(c.quantity) FROM cart_item c "
+        "WHERE c.consumer_id = cart_item.consumer_id AND c.product_id = cart_item.product_id) "
+        "WHERE id IN (SELECT MIN(id) FROM cart_item GROUP BY consumer_id, product_id HAVING COUNT(*) > 1)"))
+    db.session.execute(text(
+        "DELETE FROM cart_item WHERE id NOT IN (SELECT MIN(id) FROM cart_item GROUP BY consumer_id, product_id)"))
+    _create_indexes(CartItem, 'uq_cart_item_consumer_product')
+
+@migration(2, '外部キーと並べ替え用のインデックスを追加する')
+def migrate_add_indexes():
+    _create_indexes(Product, 'ix_product_producer_id', 'ix_product_price_id', 'ix_product_name_id')
+    _create_indexes(CartItem, 'ix_cart_item_product_id')
+
+@migration(3, '売れ行きの商品一覧を数量順に読むインデックスに置き換える')
+def migrate_product_stat_index():
+    _create_indexes(ProductStat, 'ix_product_stat_producer_quantity')
+    db.session.execute(text('DROP INDEX IF EXISTS ix_product_stat_producer_id'))
+
+@migration(4, '商品検索用の全文検索テーブルを作成し、既存の商品を登録する')
+def migrate_search_index():
+    if ensure_search_index():
+        rebuild_search_index()
+
+def run_migrations():
+    """未適用のマイグレーションを番号順に実行し、適用した (番号, 説明) のリストを返す。"""
+    applied = set(db.session.scalars(select(SchemaMigration.version)))
+    done = []
+    for version, description, func in MIGRATIONS:
+        if version in applied:
+            continue
+        func()
+        db.session.add(SchemaMigration(version=version, description=description,
+                                       applied_at=datetime.datetime.now(datetime.timezone.utc)))
+        db.session.commit()
+        done.append((version, description))
+    return done
+
+def init_db():
+    """テーブル・インデックスとアップロード先フォルダを作成し、未適用のマイグレーション
+    (検索インデックスの作成を含む) を実行する (何度実行してもよい)。"""
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    db.create_all()
+    run_migrations()
+
+DEFAULT_PROFILE_IMAGE_FILENAME = 'default_producer_profile.jpg'
+DEFAULT_PROFILE_IMAGE_PLACEHOLDER = 'https://via.placeholder.com/120/CCCCCC/FFFFFF?text=No+Image'
+
+def generate_default_assets():
+    """生産者の初期プロフィール画像を static/uploads に生成する。作成したら True を返す。"""
+    default_profile_image_path = os.path.join(UPLOAD_FOLDER, DEFAULT_PROFILE_IMAGE_FILENAME)
+    if os.path.exists(default_profile_image_path):
+        return False
+    try:
+        from PIL import ImageDraw, ImageFont # Pillow ライブラリが必要
+    except ImportError:
+        print("Pillow library not found. Please install it with 'pip install Pillow' to generate default image.")
+        # Pillowがない場合は、手動で画像を配置するか、他のデフォルトURLを設定
+        return False
 
+    img = Image.new('RGB', (400, 400), color = (76, 175, 80)) # Green-500
+    d = ImageDraw.Draw(img)
+    # フォントのパスは環境によって異なる可能性があります
+    try:
+        font = ImageFont.truetype("arial.ttf", 80) # Windows
+    except IOError:
+        try:
+            font = ImageFont.truetype("/Library/Fonts/Arial.ttf", 80) # macOS
+        except IOError:
+            font = ImageFont.load_default() # Fallback
+
+    label = "P" # ProducerのP
+    text_bbox = d.textbbox((0,0), label, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
+
+    x = (400 - text_width) / 2
+    y = (400 - text_height) / 2
+    d.text((x, y), label, fill=(255, 255, 255), font=font)
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    img.save(default_profile_image_path)
+    return True
+
+def seed_data():
+    """初期データを追加する (もしデータが空の場合)。"""
+    producer1 = Producer.query.filter_by(username='tachi_farm').first()
+    if not producer1:
+        # generate-default-assets で作った初期プロフィール画像があれば使う
+        default_profile_image_path = os.path.join(UPLOAD_FOLDER, DEFAULT_PROFILE_IMAGE_FILENAME)
+        if os.path.exists(default_profile_image_path):
+            profile_image_url = f'{current_app.static_url_path}/uploads/{DEFAULT_PROFILE_IMAGE_FILENAME}'
+        else:
+            profile_image_url = DEFAULT_PROFILE_IMAGE_PLACEHOLDER
 
         producer1 = Producer(
             username='tachi_farm',
-            password=generate_password_hash('password123'),
+            password=generate_password_hash('password123', PASSWORD_HASH_METHOD),
             account_name='立花考志',
             bio='日本のトランプです。',
             profile_image=profile_image_url, # 生成したURLを使用
@@ -118,17 +1919,12 @@ with app.app_context():
         # 既存のプロデューサーに username と password がなければ追加（または更新）
         if not producer1.username or not producer1.password:
             producer1.username = 'tachi_farm'
-            producer1.password = generate_password_hash('password123')
+            producer1.password = generate_password_hash('password123', PASSWORD_HASH_METHOD)
             db.session.commit()
         # YouTube動画URLがまだ更新されていなければ、埋め込み形式に更新
         if not producer1.youtube_video or not producer1.youtube_video.startswith('https://www.youtube.com/embed/'):
              producer1.youtube_video = 'https://www.youtube.com/embed/M0000000000'
              db.session.commit()
-        # プロフィール画像が設定されていなければ、デフォルトを設定 (必要であれば)
-        if not producer1.profile_image:
-            # ここでデフォルト画像を再設定するかは要検討。通常は登録時に設定される。
-            pass
-
 
     if not Product.query.first():
         products_data = [
@@ -140,45 +1936,249 @@ with app.app_context():
         for data in products_data:
             product = Product(**data)
             db.session.add(product)
+        db.session.flush()
+        index_producer_products(producer1.id)
         db.session.commit()
 
+@bp.cli.command('init-db')
+def init_db_command():
+    """テーブルとインデックスを作成する。"""
+    init_db()
+    print('データベースを初期化しました。')
+
+@bp.cli.command('migrate-db')
+def migrate_db_command():
+    """既存のDBに未適用のマイグレーションを実行する (新しく追加されたテーブルも作成する)。"""
+    db.create_all()
+    done = run_migrations()
+    for version, description in done:
+        print(f'{version:04d}: {description}')
+    print(f'マイグレーションを {len(done)} 件適用しました。')
+
+# 主要なクエリの実行計画の確認
+# 代表的なページ・APIを実際に呼び、発行された SELECT/UPDATE/DELETE を EXPLAIN QUERY PLAN にかけて、
+# テーブル全体の走査や、インデックスを使わない並べ替えになっていないかを調べる (SQLite のみ)。
+QUERY_PLAN_ALLOWED_SCANS = {'CONSTANT ROW'} # 走査しても問題ないもの
+
+def query_plan_problems(statement, plan_rows):
+    """実行計画のうち、位置を決めずにテーブルやインデックスを読む (SCAN) 行と、結果を後から並べ替える行を返す。
+    インデックスを使っていても、(列>?) などの検索条件が付いた SEARCH でなければ先頭から読むことになる。"""
+    details = [row[-1] for row in plan_rows]
+    virtual = any('VIRTUAL TABLE' in detail for detail in details)
+    problems = []
+    for detail in details:
+        if detail.startswith('SCAN ') and 'VIRTUAL TABLE' not in detail \
+                and detail[len('SCAN '):] not in QUERY_PLAN_ALLOWED_SCANS:
+            problems.append(detail)
+        elif detail.startswith('USE TEMP B-TREE FOR ORDER BY') and not virtual:
+            # 全文検索の関連度順の並べ替えは、一致した行だけが対象なので除く
+            problems.append(detail)
+    return problems
+
+def _hot_query_scenarios(app):
+    """(名前, 関数) のリスト。各関数の中で発行されたSQLを確認対象にする。
+    すべてのシナリオを実行できるだけのデータ (2件以上の商品と、カートに商品のある消費者) が無ければ
+    確認を省かずにエラーにする。"""
+    cart_item = db.session.execute(select(CartItem.consumer_id, CartItem.product_id).limit(1)).first()
+    producer_id = db.session.scalar(select(Product.producer_id).limit(1))
+    if cart_item is None or producer_id is None:
+        raise click.ClickException('確認に必要なデータがありません。商品とカートの入ったDBで実行してください '
+                                   '(benchmarks/datagen.py で作成できます)。')
+    consumer_id, product_id = cart_item
+    client = app.test_client()
+
+    def get(path, **session_values):
+        def run():
+            with client.session_transaction() as client_session:
+                client_session.clear()
+                client_session.update(session_values)
+            response = client.get(path)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{path}: {response.status_code}')
+        return run
+
+    def cart_writes():
+        upsert_cart_item(consumer_id, product_id, 1)
+        upsert_cart_item(consumer_id, product_id, 2, replace=True)
+        changes = CartChanges()
+        for deleted_product_id, quantity in delete_cart_items(CartItem.consumer_id == consumer_id,
+                                                              CartItem.product_id == product_id):
+            changes.change(deleted_product_id, quantity, 0)
+        record_cart_changes(changes)
+        bump_cart_version(consumer_id)
+
+    scenarios = [('商品一覧', get('/'))]
+    for sort in PRODUCT_SORTS:
+        _, cursor = fetch_product_page(sort, limit=1)
+        if cursor is None:
+            raise click.ClickException('2ページ目を確認するには商品が2件以上必要です。')
+        scenarios += [
+            (f'商品API ({sort})', get(f'/api/products?sort={sort}')),
+            (f'商品API ({sort}, 2ページ目)', get(f'/api/products?sort={sort}&cursor={cursor}&limit=1')),
+        ]
+    if search_enabled():
+        scenarios.append(('検索', get('/api/search?q=トマト')))
+    scenarios += [
+        ('生産者の公開ページ', get(f'/producer/{producer_id}')),
+        ('生産者ダッシュボード', get('/producer', producer_id=producer_id)),
+        ('売れ行きAPI', get('/api/producer/analytics', producer_id=producer_id)),
+        ('生産者の商品の検索インデックス更新', lambda: index_producer_products(producer_id)),
+        ('カート', get('/cart', consumer_id=consumer_id)),
+        ('カートの概要', get('/api/cart/summary', consumer_id=consumer_id)),
+        ('カートの更新', cart_writes),
+    ]
+    return scenarios
+
+def explain_hot_queries(app):
+    """各シナリオを実行して発行されたSQLの実行計画を調べ、(名前, [(SQL, 実行計画, 問題点)]) のリストを返す。
+    書き込みを伴うシナリオの変更はシナリオごとに取り消す。"""
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+            captured.append((statement, parameters))
+
+    results = []
+    for name, run in _hot_query_scenarios(app):
+        fragment_cache.clear() # キャッシュ済みの断片があるとクエリが発行されないため
+        captured.clear()
+        event.listen(Engine, 'before_cursor_execute', capture)
+        try:
+            run()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', capture)
+        plans = []
+        for statement, parameters in captured:
+            if statement.lstrip().upper().startswith('INSERT') and ' SELECT ' not in statement.upper():
+                continue # VALUES だけの INSERT は走査しない
+            plan = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+            plans.append((statement, plan, query_plan_problems(statement, plan)))
+        db.session.rollback() # 書き込みを伴うシナリオの変更を取り消す
+        results.append((name, plans))
+    return results
+
+@bp.cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='問題の無いクエリの実行計画も表示する')
+def check_query_plans_command(verbose):
+    """主要なクエリがテーブル全体の走査になっていないかを EXPLAIN QUERY PLAN で確認する。
+    問題があれば終了コード 1 で終わる (CI 用)。データは変更しない。"""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('check-query-plans は SQLite のDBでのみ実行できます。')
+    failures = 0
+    for name, plans in explain_hot_queries(current_app._get_current_object()):
+        bad = [p for p in plans if p[2]]
+        failures += len(bad)
+        print(f"{'NG' if bad else 'OK'} {name} ({len(plans)} クエリ)")
+        for statement, plan, problems in plans:
+            if problems or verbose:
+                print('    ' + ' '.join(statement.split()))
+                for row in plan:
+                    print(f'      {row[-1]}')
+    if failures:
+        raise click.ClickException(f'テーブル全体の走査などが {failures} 件あります。')
+    print('すべてのクエリがインデックスを使っています。')
+
+@bp.cli.command('seed')
+def seed_command():
+    """初期データ (サンプルの生産者・商品) を投入する。"""
+    seed_data()
+    print('初期データを投入しました。')
+
+@bp.cli.command('generate-default-assets')
+def generate_default_assets_command():
+    """初期プロフィール画像などの既定ファイルを生成する。"""
+    if generate_default_assets():
+        print('初期プロフィール画像を生成しました。')
+    else:
+        print('生成するファイルはありません。')
+
+def create_app(test_config=None):
+    """アプリを作成する。設定は環境変数から読み、test_config で上書きできる。
+    DB接続はリクエストやコマンドで初めて必要になった時に張られる。"""
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY=SECRET_KEY,
+        UPLOAD_FOLDER=UPLOAD_FOLDER,
+        SQLALCHEMY_DATABASE_URI=DATABASE_URL,
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SLOW_REQUEST_MS=float(os.environ.get('SLOW_REQUEST_MS', '0')), # 0 なら遅いリクエストのログを出さない
+        SQL_QUERY_BUDGET=None, # テスト時の1リクエストあたりのSQL実行数の上限 (None なら無制限)
+        SQL_QUERY_BUDGETS={}, # エンドポイントごとの上限 (例: {'main.index': 3})
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+        MAX_CONTENT_LENGTH=int(MAX_UPLOAD_MB * 1024 * 1024),
+        MAX_IMPORT_CONTENT_LENGTH=int(MAX_IMPORT_MB * 1024 * 1024),
+        # 設定すると /assets の配信を X-Accel-Redirect で nginx に任せる (例: '/protected-static/')
+        MEDIA_ACCEL_REDIRECT_PREFIX=os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX'),
+        EVENT_BROKER_URL=os.environ.get('EVENT_BROKER_URL'), # 例: redis://localhost:6379/0
+        SSE_ENABLED=os.environ.get('SSE_ENABLED', 'auto'), # auto / 1 / 0
+    )
+    if DATABASE_READ_URL:
+        app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': DATABASE_READ_URL, **engine_options(DATABASE_READ_URL)}}
+    if test_config:
+        app.config.update(test_config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    app.request_class = UploadRequest
+    db.init_app(app)
+    fragment_cache.init_app(app)
+    catalog_snapshot.init_app(app)
+    event_broker.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
 # 生産者用プロフィール表示ページ (既存の/producer/profileを動的に変更)
-@app.route('/producer/profile')
+@bp.route('/producer/profile')
 def producer_profile():
     if 'producer_id' not in session:
         flash('生産者としてログインしてください。', 'warning')
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
     
-    producer = Producer.query.get(session['producer_id'])
-    if not producer:
+    # プレビューページは利用者ごとの部分を含まないため、ページ全体をキャッシュする
+    producer_id = session['producer_id']
+    def render_preview():
+        producer = Producer.query.get(producer_id)
+        return render_template('preview_profile.html', producer=producer) if producer else None
+    page = fragment_cache.get_or_render(
+        ('preview_profile', producer_id, fragment_cache.version(('producer', producer_id))), render_preview)
+    if page is None:
         flash('生産者アカウントが見つかりません。', 'danger')
         session.pop('producer_id', None)
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
         
-    return render_template('preview_profile.html', producer=producer)
+    return page
 
 # 個別の生産者の公開プロフィールページ (新しいルート)
-@app.route('/producer/<int:producer_id>')
+@bp.route('/producer/<int:producer_id>')
+@read_only
 def view_producer_profile(producer_id):
-    producer = Producer.query.get(producer_id)
-    if not producer:
+    # ヘッダー (ログイン状態) は毎回描画し、プロフィール本体だけキャッシュする
+    def render_profile():
+        producer = Producer.query.get(producer_id)
+        if not producer:
+            return None
+        return Markup(render_template('_producer_profile.html', producer=producer)), producer.account_name
+    cached = fragment_cache.get_or_render(
+        ('producer_profile', producer_id, fragment_cache.version(('producer', producer_id))), render_profile,
+        scope=('producer', producer_id))
+    if cached is None:
         flash('指定された生産者が見つかりません。', 'danger')
-        return redirect(url_for('index'))
-    return render_template('public_producer_profile.html', producer=producer)
+        return redirect(url_for('main.index'))
+    profile_html, account_name = cached
+    return render_template('public_producer_profile.html', profile_html=profile_html, account_name=account_name)
 
 
 # 生産者用プロフィール編集ページ
-@app.route('/producer/edit-profile', methods=['GET', 'POST'])
+@bp.route('/producer/edit-profile', methods=['GET', 'POST'])
 def producer_edit_profile():
     if 'producer_id' not in session:
         flash('生産者としてログインしてください。', 'warning')
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
     
     producer = Producer.query.get(session['producer_id'])
     if not producer:
         flash('生産者アカウントが見つかりません。', 'danger')
         session.pop('producer_id', None)
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
 
     if request.method == 'POST':
         producer.account_name = request.form['account_name']
@@ -189,23 +2189,24 @@ def producer_edit_profile():
 
         # プロフィール画像のファイルがアップロードされた場合
         if profile_image_file and allowed_file(profile_image_file.filename):
-            filename = str(uuid.uuid4()) + os.path.splitext(profile_image_file.filename)[1]
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            profile_image_file.save(filepath)
-            producer.profile_image = url_for('static', filename=f'uploads/{filename}')
+            producer.profile_image, filepath = store_upload(profile_image_file)
+            schedule_derivatives(filepath, producer.id)
         # ファイルがアップロードされず、かつ既存の画像URLもクリアしたい場合 (オプション)
         # elif not profile_image_file and 'profile_image_file' in request.files and not request.form.get('current_profile_image_url'):
         #     producer.profile_image = None # 画像を削除するロジック
 
+        db.session.flush()
+        index_producer_products(producer.id) # 生産者名の変更を検索インデックスに反映
         db.session.commit()
+        invalidate_producer(producer.id)
         
         flash('プロフィールが更新されました。', 'success')
-        return redirect(url_for('producer_profile'))
+        return redirect(url_for('main.producer_profile'))
 
     return render_template('edit_profile.html', producer=producer)
 
 # 生産者ログインページ
-@app.route('/producer/login', methods=['GET', 'POST'])
+@bp.route('/producer/login', methods=['GET', 'POST'])
 def producer_login():
     if request.method == 'POST':
         username = request.form['username']
@@ -213,16 +2214,17 @@ def producer_login():
 
         producer = Producer.query.filter_by(username=username).first()
 
-        if producer and check_password_hash(producer.password, password):
+        if producer and verify_password(producer.password, password):
+            upgrade_password_hash(producer, password)
             session['producer_id'] = producer.id
             flash('生産者としてログインしました！', 'success')
-            return redirect(url_for('producer_dashboard'))
+            return redirect(url_for('main.producer_dashboard'))
         else:
             flash('ログイン失敗: ユーザー名またはパスワードが間違っています', 'danger')
     return render_template('producer_login.html')
 
 # 生産者登録ページ
-@app.route('/producer/register', methods=['GET', 'POST'])
+@bp.route('/producer/register', methods=['GET', 'POST'])
 def producer_register():
     if request.method == 'POST':
         username = request.form['username']
@@ -237,13 +2239,13 @@ def producer_register():
 
         if password != password_confirm:
             flash('パスワードが一致しません', 'danger')
-            return redirect(url_for('producer_register'))
+            return redirect(url_for('main.producer_register'))
         
         if Producer.query.filter_by(username=username).first():
             flash('このユーザー名はすでに存在します', 'danger')
-            return redirect(url_for('producer_register'))
+            return redirect(url_for('main.producer_register'))
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = hash_password(password)
         new_producer = Producer(
             username=username,
             password=hashed_password,
@@ -256,20 +2258,61 @@ def producer_register():
         db.session.commit()
 
         flash('生産者アカウントが作成されました。ログインしてください。', 'success')
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
 
     return render_template('producer_register.html')
 
 
-@app.route('/producer/logout')
+@bp.route('/producer/logout')
 def producer_logout():
     session.pop('producer_id', None)
     flash('生産者アカウントからログアウトしました。', 'info')
-    return redirect(url_for('index'))
-
+    return redirect(url_for('main.index'))
+
+
+# 商品一覧APIエンドポイント (無限スクロール用)
+@bp.route('/api/products', methods=['GET'])
+@read_only
+def list_products():
+    sort = request.args.get('sort', 'default')
+    if sort not in PRODUCT_SORTS:
+        sort = 'default'
+    limit = request.args.get('limit', PRODUCTS_PER_PAGE, type=int)
+    limit = max(1, min(limit, MAX_PRODUCTS_PER_PAGE))
+    cursor = request.args.get('cursor')
+
+    products, next_cursor = fetch_product_page(sort, cursor, limit)
+    return jsonify({
+        'status': 'success',
+        'products': [product_to_dict(p) for p in products],
+        'next_cursor': next_cursor,
+    })
+
+# 断片キャッシュのヒット率確認用エンドポイント
+@bp.route('/api/cache/stats')
+def cache_stats():
+    return jsonify({'status': 'success', 'fragment_cache': fragment_cache.stats()})
+
+# 商品検索APIエンドポイント
+@bp.route('/api/search')
+@read_only
+def search():
+    q = request.args.get('q', '').strip()
+    limit = request.args.get('limit', PRODUCTS_PER_PAGE, type=int)
+    limit = max(1, min(limit, MAX_PRODUCTS_PER_PAGE))
+    page = max(1, request.args.get('page', 1, type=int))
+
+    products, has_more = search_products(q, limit, (page - 1) * limit)
+    return jsonify({
+        'status': 'success',
+        'query': q,
+        'page': page,
+        'products': [product_to_dict(p) for p in products],
+        'has_more': has_more,
+    })
 
 # 商品出品APIエンドポイント
-@app.route('/api/products', methods=['POST'])
+@bp.route('/api/products', methods=['POST'])
 def add_product():
     if 'producer_id' not in session:
         return jsonify({'status': 'error', 'message': '生産者としてログインが必要です。'}), 401
@@ -291,15 +2334,15 @@ def add_product():
         price = int(price_str)
         if price < 0:
             return jsonify({'status': 'error', 'message': '価格は0以上である必要があります。'}), 400
+        if price > MAX_PRICE:
+            return jsonify({'status': 'error', 'message': f'価格は{MAX_PRICE}以下である必要があります。'}), 400
     except ValueError:
         return jsonify({'status': 'error', 'message': '価格は有効な数値である必要があります。'}), 400
 
     image_url = None
     if product_image and allowed_file(product_image.filename):
-        filename = str(uuid.uuid4()) + os.path.splitext(product_image.filename)[1]
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        product_image.save(filepath)
-        image_url = url_for('static', filename=f'uploads/{filename}')
+        image_url, filepath = store_upload(product_image)
+        schedule_derivatives(filepath, producer.id)
     else:
         return jsonify({'status': 'error', 'message': '無効なファイル形式です。許可されるのはpng, jpg, jpeg, gifです。'}), 400
 
@@ -312,13 +2355,48 @@ def add_product():
     )
 
     db.session.add(new_product)
+    db.session.flush()
+    index_products([new_product.id])
+    product_event = product_to_dict(new_product)
     db.session.commit()
+    invalidate_producer(producer.id)
+    event_broker.publish(CATALOG_CHANNEL, 'product', product_event)
 
     return jsonify({'status': 'success', 'message': '商品が正常に出品されました！', 'product_id': new_product.id}), 201
 
 
+# 商品一括登録APIエンドポイント
+@bp.route('/api/products/import', methods=['POST'])
+def import_products_api():
+    if 'producer_id' not in session:
+        return jsonify({'status': 'error', 'message': '生産者としてログインが必要です。'}), 401
+    producer = Producer.query.get(session['producer_id'])
+    if not producer:
+        return jsonify({'status': 'error', 'message': '生産者アカウントが見つかりません。'}), 404
+
+    # 画像zipを含むため、通常のアップロードより大きい上限にする (フォームを読む前に設定する)
+    request.max_content_length = current_app.config['MAX_IMPORT_CONTENT_LENGTH']
+    rows_file = request.files.get('productsFile')
+    images_zip = request.files.get('imagesZip')
+    if not rows_file or not rows_file.filename:
+        return jsonify({'status': 'error', 'message': 'CSVまたはJSONLファイルを選択してください。'}), 400
+    fmt = import_format(rows_file.filename, request.form.get('format'))
+    if fmt is None:
+        return jsonify({'status': 'error', 'message': 'ファイル形式は .csv または .jsonl にしてください。'}), 400
+    if images_zip and images_zip.filename and not zipfile.is_zipfile(images_zip.stream):
+        return jsonify({'status': 'error', 'message': '画像は zip にまとめてください。'}), 400
+
+    report = import_products(producer.id, rows_file.stream, fmt,
+                             images_zip.stream if images_zip and images_zip.filename else None,
+                             max_image_size=current_app.config['MAX_CONTENT_LENGTH'])
+    status = 400 if report['error_count'] and not report['imported'] else 200
+    return jsonify({'status': 'success' if status == 200 else 'error',
+                    'message': f"{report['imported']} 件の商品を登録しました。",
+                    **report}), status
+
+
 # 消費者用ログインページ
-@app.route('/consumer/login', methods=['GET', 'POST'])
+@bp.route('/consumer/login', methods=['GET', 'POST'])
 def consumer_login():
     if request.method == 'POST':
         username = request.form['username']
@@ -326,17 +2404,18 @@ def consumer_login():
         
         consumer = Consumer.query.filter_by(username=username).first()
         
-        if consumer and check_password_hash(consumer.password, password):
+        if consumer and verify_password(consumer.password, password):
+            upgrade_password_hash(consumer, password)
             session['consumer_id'] = consumer.id
             flash('ログインしました！', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             flash('ログイン失敗: ユーザー名またはパスワードが間違っています', 'danger')
     
     return render_template('consumer_login.html')
 
 # 消費者登録ページ
-@app.route('/consumer/register', methods=['GET', 'POST'])
+@bp.route('/consumer/register', methods=['GET', 'POST'])
 def consumer_register():
     if request.method == 'POST':
         username = request.form['username']
@@ -345,31 +2424,181 @@ def consumer_register():
         
         if password != password_confirm:
             flash('パスワードが一致しません', 'danger')
-            return redirect(url_for('consumer_register'))
+            return redirect(url_for('main.consumer_register'))
         
         if Consumer.query.filter_by(username=username).first():
             flash('このユーザー名はすでに存在します', 'danger')
-            return redirect(url_for('consumer_register'))
+            return redirect(url_for('main.consumer_register'))
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = hash_password(password)
         new_consumer = Consumer(username=username, password=hashed_password)
         db.session.add(new_consumer)
         db.session.commit()
 
         flash('アカウントが作成されました。ログインしてください。', 'success')
-        return redirect(url_for('consumer_login'))
+        return redirect(url_for('main.consumer_login'))
 
     return render_template('consumer_register.html')
 
 # 消費者ログアウト
-@app.route('/consumer/logout')
+@bp.route('/consumer/logout')
 def consumer_logout():
     session.pop('consumer_id', None)
     flash('ログアウトしました。', 'info')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
+
+def dialect_insert(model):
+    # INSERT ... ON CONFLICT (upsert) は方言ごとの insert で組み立てる。使う時だけ import する
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+# カート操作
+MAX_CART_QUANTITY = 999 # 1商品あたりの数量の上限
+MAX_CART_BATCH_OPERATIONS = 100 # 一括操作で受け付ける最大件数
+
+def _is_quantity(value, minimum=1):
+    return isinstance(value, int) and not isinstance(value, bool) and minimum <= value <= MAX_CART_QUANTITY
+
+def upsert_cart_item(consumer_id, product_id, quantity, replace=False):
+    """カートの数量を1文で加算 (replace=True なら上書き) する。
+    INSERT ... SELECT で商品の存在確認も同じ文で行い、(consumer_id, product_id) の一意インデックスで
+    衝突したら既存行の数量を更新する。同時に押されても行が重複したり加算が失われたりしない。
+    変更前と変更後の数量を返し (集計値の差分に使う)、商品が存在しなければ None を返す。"""
+    old_quantity = None
+    if replace:
+        # 上書きの場合は変更前の数量が RETURNING で得られないため先に読む。
+        # 同時更新で集計値がずれた場合は rollup-analytics で補正する
+        old_quantity = db.session.query(CartItem.quantity).filter_by(
+            consumer_id=consumer_id, product_id=product_id).scalar() or 0
+    stmt = dialect_insert(CartItem).from_select(
+        ['consumer_id', 'product_id', 'quantity'],
+        select(literal(consumer_id), Product.id, literal(quantity)).where(Product.id == product_id))
+    new_quantity = stmt.excluded.quantity if replace else CartItem.quantity + stmt.excluded.quantity
+    stmt = stmt.on_conflict_do_update(index_elements=['consumer_id', 'product_id'],
+                                      set_={'quantity': new_quantity}).returning(CartItem.quantity)
+    new_quantity = db.session.execute(stmt).scalar()
+    if new_quantity is None:
+        return None
+    return (new_quantity - quantity if old_quantity is None else old_quantity), new_quantity
+
+def delete_cart_items(*criteria):
+    """条件に合うカートの行を削除し、[(product_id, 削除した数量)] を返す。"""
+    stmt = delete(CartItem).where(*criteria).returning(CartItem.product_id, CartItem.quantity)
+    return db.session.execute(stmt).all()
+
+def bump_cart_version(consumer_id):
+    # カートの版番号を1文で進め (行が無ければ作る)、新しい版番号を返す。呼び出し側の commit で確定する
+    stmt = dialect_insert(CartVersion).values(consumer_id=consumer_id, version=1)
+    stmt = stmt.on_conflict_do_update(index_elements=['consumer_id'],
+                                      set_={'version': CartVersion.version + 1})
+    return db.session.execute(stmt.returning(CartVersion.version)).scalar()
+
+def cart_version(consumer_id):
+    return db.session.query(CartVersion.version).filter_by(consumer_id=consumer_id).scalar() or 0
+
+def cart_totals(consumer_id):
+    """カート内の合計数量と合計金額を1回の集計クエリで求める。"""
+    item_count, total_price = db.session.query(
+        func.coalesce(func.sum(CartItem.quantity), 0),
+        func.coalesce(func.sum(Product.price * CartItem.quantity), 0),
+    ).join(Product, CartItem.product_id == Product.id).filter(CartItem.consumer_id == consumer_id).one()
+    return int(item_count), int(total_price)
+
+# 売れ行きの集計
+# カートの変更ごとに (商品ID, カート数の増減, 数量の増減) を記録し、commit 前にまとめて集計表に加算する。
+# 集計値は rollup-analytics でカートの実データから作り直せる (初回導入時・ずれた場合の補正用)。
+ANALYTICS_DAYS = 30 # ダッシュボードに表示する日数
+
+class CartChanges:
+    def __init__(self):
+        self.deltas = defaultdict(lambda: [0, 0]) # product_id -> [カート数の増減, 数量の増減]
+
+    def change(self, product_id, old_quantity, new_quantity):
+        delta = self.deltas[product_id]
+        delta[0] += (new_quantity > 0) - (old_quantity > 0)
+        delta[1] += new_quantity - old_quantity
+
+def record_cart_changes(changes, day=None):
+    """カートの変更を商品別・生産者別の集計値と日別の集計に加算する。呼び出し側の commit で確定する。"""
+    day = day or datetime.date.today()
+    for product_id, (cart_delta, quantity_delta) in changes.deltas.items():
+        if not cart_delta and not quantity_delta:
+            continue
+        totals = {'cart_count': cart_delta, 'quantity': quantity_delta}
+        daily = {'added_quantity': max(quantity_delta, 0), 'removed_quantity': max(-quantity_delta, 0)}
+        # (モデル, 衝突判定の列, 挿入するキー列, 加算する値)。生産者IDは商品表から同じ文で引く
+        targets = (
+            (ProductStat, ['product_id'], {'product_id': literal(product_id), 'producer_id': Product.producer_id}, totals),
+            (ProducerStat, ['producer_id'], {'producer_id': Product.producer_id}, totals),
+            (ProductDailyStat, ['product_id', 'day'], {'product_id': literal(product_id), 'day': literal(day)}, daily),
+            (ProducerDailyStat, ['producer_id', 'day'], {'producer_id': Product.producer_id, 'day': literal(day)}, daily),
+        )
+        for model, index_elements, keys, values in targets:
+            stmt = dialect_insert(model).from_select(
+                list(keys) + list(values),
+                select(*keys.values(), *[literal(v) for v in values.values()]).where(Product.id == product_id))
+            table = model.__table__
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={name: table.c[name] + getattr(stmt.excluded, name) for name in values}))
+
+def rollup_analytics():
+    """商品別・生産者別の集計値をカートの実データから作り直す (日別の集計はそのまま)。"""
+    db.session.execute(delete(ProductStat))
+    db.session.execute(delete(ProducerStat))
+    db.session.execute(insert(ProductStat).from_select(
+        ['product_id', 'producer_id', 'cart_count', 'quantity'],
+        select(Product.id, Product.producer_id, func.count(CartItem.id), func.sum(CartItem.quantity))
+        .join(CartItem, CartItem.product_id == Product.id).group_by(Product.id, Product.producer_id)))
+    db.session.execute(insert(ProducerStat).from_select(
+        ['producer_id', 'cart_count', 'quantity'],
+        select(ProductStat.producer_id, func.sum(ProductStat.cart_count), func.sum(ProductStat.quantity))
+        .group_by(ProductStat.producer_id)))
+    db.session.commit()
+
+def producer_analytics(producer_id, days=ANALYTICS_DAYS):
+    """ダッシュボード用の集計値。事前に集計した表を読むだけで、カートの行は数えない。"""
+    totals = db.session.get(ProducerStat, producer_id)
+    products = db.session.query(Product.id, Product.name, ProductStat.cart_count, ProductStat.quantity) \
+        .join(ProductStat, ProductStat.product_id == Product.id) \
+        .filter(ProductStat.producer_id == producer_id, ProductStat.cart_count > 0) \
+        .order_by(ProductStat.quantity.desc(), ProductStat.product_id.desc()).all()
+    since = datetime.date.today() - datetime.timedelta(days=days - 1)
+    days_in_range = [since + datetime.timedelta(days=offset) for offset in range(days)]
+    daily = {row.day: row for row in ProducerDailyStat.query.filter(
+        ProducerDailyStat.producer_id == producer_id, ProducerDailyStat.day >= since)}
+    # 商品別の日ごとの数量は、生産者の商品から主キー (product_id, day) で範囲を読む
+    product_daily = {}
+    for row in db.session.query(ProductDailyStat).join(Product, Product.id == ProductDailyStat.product_id) \
+            .filter(Product.producer_id == producer_id, ProductDailyStat.day >= since):
+        product_daily.setdefault(row.product_id, {})[row.day] = row
+
+    def series(rows):
+        return [{'day': day.isoformat(),
+                 'added_quantity': rows[day].added_quantity if day in rows else 0,
+                 'removed_quantity': rows[day].removed_quantity if day in rows else 0}
+                for day in days_in_range]
+
+    return {
+        'cart_count': totals.cart_count if totals else 0,
+        'quantity': totals.quantity if totals else 0,
+        'products': [{'id': p.id, 'name': p.name, 'cart_count': p.cart_count, 'quantity': p.quantity,
+                      'daily': series(product_daily.get(p.id, {}))}
+                     for p in products],
+        'daily': series(daily),
+    }
+
+@bp.cli.command('rollup-analytics')
+def rollup_analytics_command():
+    """生産者ダッシュボードの集計値 (カート数・数量) をカートの実データから作り直す。"""
+    rollup_analytics()
+    print('集計値を作り直しました。')
 
 # カートに商品を追加するAPIエンドポイント
-@app.route('/add_to_cart', methods=['POST'])
+@bp.route('/add_to_cart', methods=['POST'])
 def add_to_cart():
     if 'consumer_id' not in session:
         return jsonify({'status': 'error', 'message': 'ログインが必要です。'}), 401
@@ -382,23 +2611,78 @@ def add_to_cart():
     if not product_id:
         return jsonify({'status': 'error', 'message': '商品IDが必要です。'}), 400
 
-    product = Product.query.get(product_id)
-    if not product:
-        return jsonify({'status': 'error', 'message': '商品が見つかりません。'}), 404
+    if not _is_quantity(quantity):
+        return jsonify({'status': 'error', 'message': f'数量は1から{MAX_CART_QUANTITY}の整数である必要があります。'}), 400
 
-    cart_item = CartItem.query.filter_by(consumer_id=consumer_id, product_id=product_id).first()
+    result = upsert_cart_item(consumer_id, product_id, quantity)
+    if result is None:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': '商品が見つかりません。'}), 404
 
-    if cart_item:
-        cart_item.quantity += quantity
-    else:
-        cart_item = CartItem(consumer_id=consumer_id, product_id=product_id, quantity=quantity)
-        db.session.add(cart_item)
-    
+    changes = CartChanges()
+    changes.change(product_id, *result)
+    record_cart_changes(changes)
+    version = bump_cart_version(consumer_id)
     db.session.commit()
+    publish_cart_changed(consumer_id, version)
     return jsonify({'status': 'success', 'message': 'カートに商品を追加しました！'})
 
+# カートを一括で操作するAPIエンドポイント
+# 例: {"operations": [{"op": "add", "product_id": 1, "quantity": 2},
+#                     {"op": "set", "product_id": 2, "quantity": 5},
+#                     {"op": "remove", "product_id": 3}]}
+# 連続したクリックをフロントエンドでまとめて1リクエストで送れるようにする。全件を1トランザクションで適用する
+@bp.route('/api/cart/batch', methods=['POST'])
+def batch_update_cart():
+    if 'consumer_id' not in session:
+        return jsonify({'status': 'error', 'message': 'ログインが必要です。'}), 401
+
+    consumer_id = session['consumer_id']
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'status': 'error', 'message': '操作の一覧が必要です。'}), 400
+    if len(operations) > MAX_CART_BATCH_OPERATIONS:
+        return jsonify({'status': 'error', 'message': f'一度に操作できるのは{MAX_CART_BATCH_OPERATIONS}件までです。'}), 400
+
+    changes = CartChanges()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': '操作の形式が正しくありません。', 'index': index}), 400
+        op = operation.get('op')
+        product_id = operation.get('product_id')
+        quantity = operation.get('quantity', 1)
+
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': '商品IDが必要です。', 'index': index}), 400
+
+        if op == 'remove' or (op == 'set' and quantity == 0):
+            for _, removed in delete_cart_items(CartItem.consumer_id == consumer_id, CartItem.product_id == product_id):
+                changes.change(product_id, removed, 0)
+        elif op in ('add', 'set'):
+            if not _is_quantity(quantity):
+                db.session.rollback()
+                return jsonify({'status': 'error', 'message': f'数量は1から{MAX_CART_QUANTITY}の整数である必要があります。', 'index': index}), 400
+            result = upsert_cart_item(consumer_id, product_id, quantity, replace=(op == 'set'))
+            if result is None:
+                db.session.rollback()
+                return jsonify({'status': 'error', 'message': '商品が見つかりません。', 'index': index}), 404
+            changes.change(product_id, *result)
+        else:
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': '不明な操作です。', 'index': index}), 400
+
+    record_cart_changes(changes)
+    version = bump_cart_version(consumer_id)
+    db.session.commit()
+    publish_cart_changed(consumer_id, version)
+    return jsonify({'status': 'success', 'message': 'カートを更新しました。', 'applied': len(operations)})
+
 # カートから商品を削除するAPIエンドポイント
-@app.route('/remove_from_cart', methods=['POST'])
+@bp.route('/remove_from_cart', methods=['POST'])
 def remove_from_cart():
     if 'consumer_id' not in session:
         return jsonify({'status': 'error', 'message': 'ログインが必要です。'}), 401
@@ -410,56 +2694,119 @@ def remove_from_cart():
     if not cart_item_id:
         return jsonify({'status': 'error', 'message': 'カートアイテムIDが必要です。'}), 400
 
-    cart_item = CartItem.query.filter_by(id=cart_item_id, consumer_id=consumer_id).first()
+    # 存在確認と削除を1文で行う
+    deleted = delete_cart_items(CartItem.id == cart_item_id, CartItem.consumer_id == consumer_id)
 
-    if not cart_item:
+    if not deleted:
+        db.session.rollback()
         return jsonify({'status': 'error', 'message': 'カートアイテムが見つからないか、あなたのカートにはありません。'}), 404
 
-    db.session.delete(cart_item)
+    changes = CartChanges()
+    for product_id, removed in deleted:
+        changes.change(product_id, removed, 0)
+    record_cart_changes(changes)
+    version = bump_cart_version(consumer_id)
     db.session.commit()
+    publish_cart_changed(consumer_id, version)
     return jsonify({'status': 'success', 'message': 'カートから商品を削除しました。'})
 
+# カートの概要 (合計数量・合計金額) APIエンドポイント
+# ヘッダーのバッジ表示やポーリング用。版番号から作った ETag が一致すれば集計せずに 304 を返す
+@bp.route('/api/cart/summary')
+def cart_summary():
+    if 'consumer_id' not in session:
+        return jsonify({'status': 'error', 'message': 'ログインが必要です。'}), 401
+
+    consumer_id = session['consumer_id']
+    version = cart_version(consumer_id)
+    etag = f'cart-{consumer_id}-{version}'
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        item_count, total_price = cart_totals(consumer_id)
+        response = jsonify({'status': 'success', 'item_count': item_count, 'total_price': total_price,
+                            'version': version})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' # 毎回再検証させる
+    return response
+
 # メインページ
-@app.route('/')
+@bp.route('/')
+@read_only
 def index():
-    products = Product.query.options(db.joinedload(Product.producer)).all()
-    return render_template('index.html', products=products)
+    sort = request.args.get('sort', 'default')
+    if sort not in PRODUCT_SORTS:
+        sort = 'default'
+    cursor = request.args.get('cursor')
+
+    # 商品グリッドはページ単位でキャッシュし、その中の商品カードも生産者のバージョンごとにキャッシュする。
+    # ヘッダー (ログイン/カートのリンク) は index.html 側で毎回描画する
+    def render_card(product):
+        key = ('product_card', product.id, fragment_cache.version(('producer', product.producer_id)))
+        return fragment_cache.get_or_render(key, lambda: render_template('_product_card.html', product=product))
+
+    def render_grid():
+        products, next_cursor = fetch_product_page(sort, cursor)
+        return Markup(''.join(render_card(p) for p in products)), next_cursor, bool(products)
+
+    # キーはカーソル文字列ではなく、それが指す位置にする (不正なカーソルはすべて先頭ページと同じキーになる)
+    product_grid, next_cursor, has_products = fragment_cache.get_or_render(
+        ('catalog_page', sort, page_position(sort, cursor), fragment_cache.version('catalog')), render_grid,
+        scope='catalog')
+    return render_template('index.html', product_grid=product_grid, has_products=has_products,
+                           next_cursor=next_cursor, sort=sort)
 
 # カート表示ページ
-@app.route('/cart')
+@bp.route('/cart')
 def view_cart():
     if 'consumer_id' not in session:
         flash('カートを見るにはログインが必要です。', 'warning')
-        return redirect(url_for('consumer_login'))
+        return redirect(url_for('main.consumer_login'))
 
     consumer_id = session['consumer_id']
     cart_items = CartItem.query.filter_by(consumer_id=consumer_id).options(db.joinedload(CartItem.product)).all()
     
-    total_price = sum(item.product.price * item.quantity for item in cart_items)
+    _, total_price = cart_totals(consumer_id)
 
     return render_template('cart.html', cart_items=cart_items, total_price=total_price)
 
 
 # 生産者ダッシュボード
-@app.route('/producer')
+@bp.route('/producer')
 def producer_dashboard():
     if 'producer_id' not in session:
         flash('生産者としてログインしてください。', 'warning')
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
     
     producer = Producer.query.get(session['producer_id'])
     if not producer:
         flash('生産者アカウントが見つかりません。', 'danger')
         session.pop('producer_id', None)
-        return redirect(url_for('producer_login'))
+        return redirect(url_for('main.producer_login'))
         
-    return render_template('producer_dashboard.html', producer=producer)
+    return render_template('producer_dashboard.html', producer=producer, analytics=producer_analytics(producer.id))
+
+# 生産者の売れ行き (集計値) APIエンドポイント
+@bp.route('/api/producer/analytics')
+@read_only
+def producer_analytics_api():
+    if 'producer_id' not in session:
+        return jsonify({'status': 'error', 'message': '生産者としてログインが必要です。'}), 401
+    days = request.args.get('days', ANALYTICS_DAYS, type=int)
+    if not 1 <= days <= 366:
+        return jsonify({'status': 'error', 'message': '日数は1から366で指定してください。'}), 400
+    return jsonify({'status': 'success', **producer_analytics(session['producer_id'], days)})
 
 if __name__ == '__main__':
     # Pillow がインストールされていない場合は警告を表示
-    try:
-        import PIL
-    except ImportError:
+    if Image is None:
         print("\nWARNING: Pillow library is not installed. Default profile image generation may fail.")
         print("Please install it with 'pip install Pillow' for full functionality.\n")
+    app = create_app()
+    # 開発サーバーでは、起動時にDB作成と初期データ投入まで行う
+    with app.app_context():
+        init_db()
+        generate_default_assets()
+        seed_data()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""SQL 実行数の上限 (SQL_QUERY_BUDGETS) のテスト。
+
+主要なページの SQL 実行数が上限内に収まることと、上限を超えたら QueryBudgetExceeded で
+失敗することを確かめる。N+1 になると、商品やカートの件数に比例して実行数が増えて失敗する。
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import datagen  # noqa: E402
+import server  # noqa: E402
+
+# 1 は他プロセスの変更を読む FragmentVersion の確認の分
+BUDGETS = {
+    'main.index': 2 + 1,
+    'main.view_cart': 2 + 1,
+    'main.producer_dashboard': 5 + 1,
+}
+PAGES = [('/', 'main.index'), ('/cart', 'main.view_cart'), ('/producer', 'main.producer_dashboard')]
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    path = tmp_path_factory.mktemp('db') / 'budget.db'
+    app = server.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+                             'SQL_QUERY_BUDGETS': dict(BUDGETS)})
+    with app.app_context():
+        server.init_db()
+        datagen.generate(producers=5, products=300, consumers=20, cart_items=3, seed=1)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['consumer_id'] = 1
+        session['producer_id'] = 1
+    return client
+
+
+@pytest.mark.parametrize('url', [url for url, _ in PAGES])
+def test_pages_stay_within_budget(client, url):
+    server.fragment_cache.clear() # キャッシュの無い状態 (最も SQL が多い) で確かめる
+    response = client.get(url)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('url, endpoint', PAGES)
+def test_exceeding_budget_fails(app, client, monkeypatch, url, endpoint):
+    monkeypatch.setitem(app.config, 'SQL_QUERY_BUDGETS', {**BUDGETS, endpoint: 0})
+    server.fragment_cache.clear()
+    with pytest.raises(server.QueryBudgetExceeded, match=endpoint):
+        client.get(url)
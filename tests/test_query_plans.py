@@ -0,0 +1,61 @@
+"""主要なクエリの実行計画の確認 (check-query-plans) のテスト。
+
+benchmarks/datagen.py で小さなDBを作り、すべてのシナリオがインデックスの位置から読む
+(SEARCH) 実行計画になっていることを確かめる。
+"""
+import os
+import sys
+
+import click
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import datagen  # noqa: E402
+import server  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    path = tmp_path_factory.mktemp('db') / 'plans.db'
+    app = server.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+    with app.app_context():
+        server.init_db()
+        datagen.generate(producers=5, products=300, consumers=20, cart_items=3, seed=1)
+        yield app
+
+
+def test_every_scenario_reads_by_index(app):
+    results = server.explain_hot_queries(app)
+    names = [name for name, _ in results]
+    assert '商品一覧' in names and 'カートの更新' in names
+    for sort in server.PRODUCT_SORTS:
+        assert f'商品API ({sort}, 2ページ目)' in names
+    for name, plans in results:
+        assert plans, f'{name}: クエリが発行されていません'
+        for statement, plan, problems in plans:
+            assert not problems, f"{name}: {' '.join(statement.split())} -> {problems}"
+
+
+def test_scan_using_index_without_constraint_is_a_problem():
+    plan = [(2, 0, 0, 'SCAN product USING INDEX ix_product_price_id')]
+    assert server.query_plan_problems('SELECT ... ORDER BY price LIMIT ?', plan) == [plan[0][-1]]
+    plan = [(2, 0, 0, 'SCAN product USING COVERING INDEX ix_product_name_id')]
+    assert server.query_plan_problems('SELECT ...', plan) == [plan[0][-1]]
+
+
+def test_search_and_virtual_table_are_allowed():
+    plan = [(2, 0, 0, 'SEARCH product USING INDEX ix_product_price_id (price>?)'),
+            (3, 0, 0, 'SEARCH producer_1 USING INTEGER PRIMARY KEY (rowid=?) LEFT-JOIN')]
+    assert server.query_plan_problems('SELECT ...', plan) == []
+    plan = [(2, 0, 0, 'SCAN product_search VIRTUAL TABLE INDEX 0:M3'),
+            (5, 0, 0, 'USE TEMP B-TREE FOR ORDER BY')]
+    assert server.query_plan_problems('SELECT ...', plan) == []
+
+
+def test_missing_data_is_an_error(tmp_path):
+    empty = server.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'empty.db'}"})
+    with empty.app_context():
+        server.init_db()
+        with pytest.raises(click.ClickException):
+            server.explain_hot_queries(empty)